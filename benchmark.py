@@ -0,0 +1,523 @@
+'''
+This file concerns measurement of the time and memory costs of the other
+modules, using randomly generated, but always playable, songs.
+
+Usage: python benchmark.py {name} [args...], e.g. python benchmark.py memory
+'''
+
+import math
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import music, player, tab
+from differential import random_song, test_songs
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def peak_rss():
+    ''' Peak resident set size of this process in megabytes, if known '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 2**20  # Reported in bytes
+    return peak / 2**10  # Reported in kilobytes
+
+
+def object_size(obj):
+    ''' Shallow size of obj, plus its instance __dict__ if it has one '''
+    size = sys.getsizeof(obj)
+    try: size += sys.getsizeof(obj.__dict__)
+    except AttributeError: pass
+    return size
+
+
+def memory(chords=10000, max_notes=1):
+    ''' Report per-object sizes, then the peak memory used while
+    arranging a random song of the given number of chords '''
+    chords, max_notes = int(chords), int(max_notes)
+    samples = {'Note': music.Note('E3'),
+               'Chord': music.Chord(['C4', 'E4', 'G4']),
+               'Shape': tab.Shape([(1, 3), (2, 2), (3, 0)]),
+               'Finger': player.Finger(0, 1),
+               'Hand': player.Hand([(1, 3), (2, 2), (3, 0)])}
+    for name, obj in samples.items():
+        print(f'{name:>8}: {object_size(obj)} bytes')
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    song = random_song(chords, max_notes=max_notes)
+    arr = player.Guitarist(song).arr
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'Arranged {len(arr.notes)} chords in {elapsed:.2f}s')
+    print(f'Peak traced memory: {peak / 2**20:.2f} MB')
+    rss = peak_rss()
+    if rss is not None:
+        print(f'Peak RSS: {rss:.2f} MB')
+
+
+def song(events=500000):
+    ''' Time bulk construction, transposition and slicing of a Song '''
+    events = int(events)
+    values = np.random.default_rng(0).integers(-8, 30, events)
+    start = time.perf_counter()
+    song = music.Song.from_values(values)
+    loaded = time.perf_counter()
+    song = song.transpose(2)[::2]
+    done = time.perf_counter()
+    print(f'Loaded {events} notes in {1000 * (loaded - start):.2f}ms')
+    print(f'Transposed and sliced in {1000 * (done - loaded):.2f}ms')
+
+    start = time.perf_counter()
+    music.Song([music.Note(int(v)) for v in values[:10000]])
+    print(f'Built 10000 notes one at a time in '
+          f'{1000 * (time.perf_counter() - start):.2f}ms')
+
+
+def optimize(chords=40, processes=None):
+    ''' Time a full capo and tuning sweep, in parallel and in series '''
+    song = random_song(int(chords), max_notes=1)
+    start = time.perf_counter()
+    player.Guitarist(song)
+    single = time.perf_counter() - start
+    print(f'One arrangement: {single:.2f}s')
+    for procs in (processes and int(processes), 1):
+        start = time.perf_counter()
+        options = player.optimize(song, processes=procs)
+        elapsed = time.perf_counter() - start
+        print(f'Sweep with {procs or "all"} processes: {elapsed:.2f}s '
+              f'({elapsed / single:.1f}x one arrangement), '
+              f'{len(options)} playable options')
+    best = options[0]
+    print(f'Best: capo {best.capo}, tuning {best.tuning}, score {best.score}')
+
+
+def segments(chords=200, processes=None):
+    ''' Time reading a song in one process, then across a process pool '''
+    song = random_song(int(chords), max_notes=2)
+    for procs in (1, processes and int(processes)):
+        start = time.perf_counter()
+        player.Guitarist(song, processes=procs)
+        print(f'{procs or "All"} processes: {time.perf_counter() - start:.2f}s')
+
+
+def storage(events=1000000):
+    ''' Time saving and loading a large Song in the binary format '''
+    import storage, tempfile
+    values = np.random.default_rng(0).integers(-8, 30, int(events))
+    song = music.Song.from_values(values)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'song.bin')
+        start = time.perf_counter()
+        storage.save_song(path, song)
+        saved = time.perf_counter()
+        for mmap in (True, False):
+            loaded = storage.load_song(path, mmap)
+            np.sum(loaded.values)  # Touch every page
+            del loaded
+        done = time.perf_counter()
+        print(f'{os.path.getsize(path) / 2**20:.2f} MB for {events} notes')
+        print(f'Saved in {1000 * (saved - start):.2f}ms, loaded twice '
+              f'(mapped, then read) in {1000 * (done - saved):.2f}ms')
+
+
+def midi(notes=500000):
+    ''' Time streaming a large, randomly generated MIDI file into a Song '''
+    import midi, struct, tempfile
+    rng = np.random.default_rng(0)
+    pitches = rng.integers(40, 80, int(notes)).tolist()
+    # Quarter notes at 96 ticks each, with note-offs by running status
+    events = b''.join(bytes((0, 0x90, p, 64, 0x60, p, 0)) for p in pitches)
+    events = b'\x00\xc0\x18' + events + b'\x00\xff\x2f\x00'
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'song.mid')
+        with open(path, 'wb') as f:
+            f.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, 96))
+            f.write(b'MTrk' + struct.pack('>I', len(events)) + events)
+        reader = midi.MidiFile(path)
+        song = reader.song()
+        print(f'{os.path.getsize(path) / 2**20:.2f} MB file, {len(song)} chords')
+        print(f'{reader.events} events in {reader.elapsed:.2f}s '
+              f'({reader.rate:.0f} events/s)')
+        # Streaming chords, without keeping them, needs little memory
+        tracemalloc.start()
+        for _ in midi.MidiFile(path).chords():
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'Peak memory while streaming: {peak / 2**20:.2f} MB')
+
+
+def engines(window=0):
+    ''' Compare node expansions and time of each search engine, playing
+    the test songs whole, or in passages of window chords if given '''
+    window = int(window)
+    for name, song in test_songs().items():
+        for engine in player.ENGINES:
+            g = player.Guitarist(engine=engine)
+            start = time.perf_counter()
+            if window:
+                g.read(song, DELTA=window)
+            else:
+                g.evaluate(g.play(song))
+            elapsed = time.perf_counter() - start
+            print(f'{name:>10} {engine:>8}: {g.expanded:8d} nodes expanded, '
+                  f'{len(g.steps):8d} moves scored, {elapsed:.3f}s')
+
+
+def checkpoints(chords=2000, max_notes=2):
+    ''' Compare the peak memory and time of playing a whole random song
+    by dynamic programming, with every layer kept, then with checkpoints '''
+    song = random_song(int(chords), max_notes=int(max_notes))
+    g = player.Guitarist(engine='dp')
+    paths = [g.voicings(chord) for chord in song]
+    for interval in (len(paths), None):
+        start = time.perf_counter()
+        g.play_dp(paths, interval)
+        elapsed = time.perf_counter() - start
+        # Traced separately, since tracing slows every array allocation
+        tracemalloc.start()
+        g.play_dp(paths, interval)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'Checkpoint interval {interval or math.isqrt(len(paths))}: '
+              f'{peak / 2**20:.2f} MB peak, {elapsed:.2f}s')
+
+
+def kernels(chords=8):
+    ''' Compare playing random songs by scoring every path in Python with
+    dynamic programming using the step kernels, then time the kernels '''
+    print(f'Step kernel: {"numba" if player.numba else "numpy"}')
+    for max_notes in (1, 2, 3):
+        song = random_song(int(chords), max_notes=max_notes)
+        times = []
+        for engine in ('product', 'dp'):
+            start = time.perf_counter()
+            player.Guitarist(engine=engine).play(song)
+            times.append(time.perf_counter() - start)
+        print(f'{max_notes} notes per chord: product {times[0]:.3f}s, '
+              f'dp {times[1]:.3f}s ({times[0] / times[1]:.0f}x)')
+
+    g = player.Guitarist()
+    song = random_song(200, max_notes=3)
+    state = player.Hand().state
+    pairs = []
+    for chord in song:
+        shapes = g.voicings(chord)
+        pairs += [(state, shape) for shape in shapes]
+        state = g.step(state, shapes[0])[1]
+    states = np.array([state for state, _ in pairs])
+    frets = player.shape_frets([shape for _, shape in pairs])
+    hand = player.Hand()
+    start = time.perf_counter()
+    for state, shape in pairs:
+        hand.restore(state)
+        hand.move(shape) + hand.strain
+    elapsed = time.perf_counter() - start
+    print(f'Hand.move and Hand.strain: {1e6 * elapsed / len(pairs):.2f}us per move')
+    kernels = {'NumPy': player.score_steps_numpy}
+    if player.numba:
+        kernels['numba'] = player.score_steps
+    for name, kernel in kernels.items():
+        kernel(states, frets)  # Compile first, if jitted
+        start = time.perf_counter()
+        kernel(states, frets)
+        elapsed = time.perf_counter() - start
+        print(f'{name} kernel: {1e6 * elapsed / len(pairs):.2f}us per move')
+
+
+def table(chords=1000, path=player.TABLE, repeats=3):
+    ''' Compare arranging random songs with and without the step table at
+    path, building it first if need be, with the fraction of moves found
+    in it. The table is loaded before timing, as it is once per process. '''
+    import instrument
+    start = time.perf_counter()
+    found = player.get_table(path)
+    if found is None:
+        shapes, moves = player.build_table(path)
+        print(f'Built {path}: {shapes} shapes, {moves} moves in '
+              f'{time.perf_counter() - start:.1f}s')
+        start = time.perf_counter()
+        found = player.get_table(path)
+    print(f'{path}: {os.path.getsize(path) / 2**20:.1f} MB, '
+          f'loaded in {time.perf_counter() - start:.2f}s')
+    saved = player._tables.get(player.TABLE)
+    try:
+        for max_notes in (1, 2, 3):
+            song = random_song(int(chords), max_notes=max_notes)
+            times = {}
+            for name, option in (('without', None), ('with', found)):
+                player._tables[player.TABLE] = option
+                best = None
+                for _ in range(int(repeats)):
+                    music.get_voicings.cache_clear()
+                    start = time.perf_counter()
+                    player.Guitarist(song)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                times[name] = best
+            stats = instrument.enable()
+            player.Guitarist(song)
+            instrument.disable()
+            moves = stats.counters.get('player.Hand.move', 0)
+            hits = stats.counters.get('player.table_hits', 0)
+            print(f'{max_notes} notes per chord: {times["without"]:.2f}s '
+                  f'without, {times["with"]:.2f}s with the table, '
+                  f'{hits / ((hits + moves) or 1):.0%} of moves found in it')
+    finally:
+        player._tables[player.TABLE] = saved
+
+
+def instrumented(chords=300):
+    ''' Compare the time to arrange a random song with instrumentation
+    disabled and enabled, then show what was recorded '''
+    import instrument
+    song = random_song(int(chords), max_notes=2)
+    player.Guitarist(song)  # Fill the voicing caches first
+
+    def arrange():
+        start = time.perf_counter()
+        str(player.Guitarist(song).arr)
+        return time.perf_counter() - start
+
+    print(f'Disabled: {arrange():.3f}s')
+    with instrument.collect() as stats:
+        print(f'Enabled: {arrange():.3f}s')
+    print(stats)
+
+
+def lines(segments=5000):
+    ''' Time filtering and grouping a large number of random Hough
+    segments, around 12 staffs of 5 lines each '''
+    import detect
+    rng = np.random.default_rng(0)
+    segments = int(segments)
+    staffs = rng.choice(60, segments) // 5 * 80 + rng.choice(60, segments) % 5 * 10
+    x1 = rng.integers(0, 100, segments)
+    y1 = staffs + rng.integers(0, 3, segments)
+    hough = np.stack([x1, y1, x1 + 1000, y1 + rng.integers(0, 2, segments)],
+                     axis=1).reshape(-1, 1, 4).astype(np.int32)
+    start = time.perf_counter()
+    found = detect.StaffDetector.filter_lines(None, hough)
+    groups = detect.StaffDetector.group_staffs(None, found)
+    boxes = [detect.StaffDetector.get_bounding_box(None, g) for g in groups]
+    elapsed = time.perf_counter() - start
+    print(f'{segments} segments to {len(found)} lines in {len(boxes)} staffs '
+          f'in {1e6 * elapsed:.0f}us')
+
+
+def naming(notes=10000):
+    ''' Time naming a large number of random noteheads on a staff '''
+    import detect
+    detector = detect.NoteDetector.__new__(detect.NoteDetector)
+    ys = np.random.default_rng(0).integers(-100, 200, int(notes))
+    start = time.perf_counter()
+    detector.pitch_values(ys, (0, 80))
+    values = time.perf_counter() - start
+    start = time.perf_counter()
+    detector.name_notes([(0, y) for y in ys.tolist()], (0, 80))
+    named = time.perf_counter() - start
+    print(f'{notes} pitch values in {1000 * values:.2f}ms, '
+          f'and as Notes in {1000 * named:.2f}ms')
+
+
+def _detect_pages(low_memory):
+    ''' Detect every static page, returning peak RSS before and after '''
+    import detect
+    before = peak_rss()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for filename in sorted(os.listdir('static')):
+        detect.StaffDetector(os.path.join('static', filename),
+                             low_memory=low_memory)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return before, peak_rss(), peak / 2**20, elapsed
+
+
+def detection():
+    ''' Compare the peak memory of detecting the static pages in the
+    default and low memory modes, each in a fresh process '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    context = multiprocessing.get_context('spawn')
+    for low_memory in (False, True):
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            before, after, traced, elapsed = pool.submit(
+                _detect_pages, low_memory).result()
+        print(f'{"Low memory" if low_memory else "Default"}: peak RSS '
+              f'{after:.1f} MB ({after - before:+.1f} MB for detection), '
+              f'{traced:.1f} MB peak in arrays, {elapsed:.2f}s')
+
+
+def prefilter(repeats=5):
+    ''' Compare the time spent finding notes, and the notes found, with and
+    without the connected component prefilter, over the static pages.
+    Recall is the fraction of default notes also found with the prefilter,
+    within half a note; extra notes are those found only with it. '''
+    import detect
+    staffs = [staff for filename in sorted(os.listdir('static'))
+              for staff in detect.StaffDetector(
+                  os.path.join('static', filename)).staffs]
+    found = {}
+    for enabled in (False, True):
+        elapsed = 0
+        found[enabled] = []
+        for staff in staffs:
+            staff.parent.prefilter = enabled
+            start = time.perf_counter()
+            for _ in range(int(repeats)):
+                notes = staff.find_peaks(staff.find_notes(), staff.note_size)
+            elapsed += time.perf_counter() - start
+            found[enabled].append(notes)
+            staff.parent.prefilter = False
+        pixels = sum(staff.gray.size for staff in staffs)
+        print(f'{"Prefilter" if enabled else "Default"}: '
+              f'{1000 * elapsed / int(repeats):.1f}ms for {len(staffs)} staffs, '
+              f'{pixels * int(repeats) / elapsed / 1e6:.1f} Mpixels/s')
+    total = recalled = extra = 0
+    for staff, full, filtered in zip(staffs, found[False], found[True]):
+        distance = (np.abs(full['x'][:, None] - filtered['x'][None, :])
+                    + np.abs(full['y'][:, None] - filtered['y'][None, :]))
+        close = distance <= staff.note_size / 2
+        total += len(full)
+        recalled += int(close.any(axis=1).sum())
+        extra += int((~close.any(axis=0)).sum())
+    print(f'Recall {recalled}/{total} ({recalled / max(1, total):.1%}), '
+          f'{extra} extra notes')
+
+
+def threads(workers=4, repeats=3):
+    ''' Time note detection of every staff of the largest static page, one
+    staff at a time and in a pool of threads '''
+    import detect
+    pages = [os.path.join('static', f) for f in os.listdir('static')]
+    page = detect.StaffDetector(max(pages, key=os.path.getsize))
+    for n in (1, int(workers)):
+        start = time.perf_counter()
+        for _ in range(int(repeats)):
+            page.detect_notes(n)
+        elapsed = (time.perf_counter() - start) / int(repeats)
+        print(f'{n} thread{"s" * (n > 1)}: {len(page.staffs)} staffs of '
+              f'{page.name} in {1000 * elapsed:.1f}ms '
+              f'({os.cpu_count()} CPUs available)')
+
+
+def prefetch(copies=4, ahead=2):
+    ''' Compare detecting copies of every static page one after another,
+    loading each just before it is detected, and with a PageLoader loading
+    pages in the background '''
+    import detect
+    names = sorted(os.path.join('static', f)
+                   for f in os.listdir('static')) * int(copies)
+    start = time.perf_counter()
+    for name in names:
+        detect.StaffDetector(name)
+    print(f'Serial: {len(names)} pages in {time.perf_counter() - start:.2f}s')
+    loader = detect.PageLoader(names, int(ahead))
+    start = time.perf_counter()
+    for name, page in loader:
+        detect.StaffDetector(name, page=page)
+    report = loader.report()
+    print(f'Prefetch: {len(names)} pages in {time.perf_counter() - start:.2f}s,'
+          f' {report["loading"]:.2f}s loading, {report["stalled"]:.2f}s '
+          f'stalled, {report["blocked"]:.2f}s blocked, mean depth '
+          f'{report["mean_depth"]:.1f}/{ahead}, {report["empty"]} empty')
+
+
+def serving(requests=200, concurrency=8, workers=2, queue=16):
+    ''' Run a transcription service with a pool of worker processes, and
+    put it under load from concurrent clients, first with songs, then with
+    a static page '''
+    import asyncio, json, service
+
+    async def run():
+        s = service.Service(int(workers), int(queue))
+        await s.start(0)
+        song = json.dumps({'notes': [['G3', 'B3'], 'A3', 'B3', 'E4']}).encode()
+        with open(os.path.join('static', 'line.png'), 'rb') as f:
+            page = f.read()
+        try:
+            for target, body, n in (('/song', song, int(requests)),
+                                    ('/image', page, int(requests) // 4)):
+                report = await service.load_test(
+                    target, body, n, int(concurrency), s.address[1])
+                latency = report.get('latency', {})
+                print(f'{target}: {report["throughput"]:.1f} requests/s, '
+                      f'p50 {latency.get("p50", 0):.1f}ms, '
+                      f'p99 {latency.get("p99", 0):.1f}ms, '
+                      f'responses {report["responses"]}')
+        finally:
+            await s.close()
+
+    asyncio.run(run())
+
+
+def watching(copies=5):
+    ''' Time a watcher's first pass over a folder of copies of the static
+    pages, then passes with nothing new, and with one new page '''
+    import shutil, tempfile, watch
+    names = sorted(os.listdir('static'))
+    with tempfile.TemporaryDirectory() as folder:
+        past = time.time() - 10
+        for i in range(int(copies)):
+            for name in names:
+                path = os.path.join(folder, f'{i}-{name}')
+                shutil.copy(os.path.join('static', name), path)
+                os.utime(path, (past, past))
+        watcher = watch.Watcher(folder)
+        start = time.perf_counter()
+        counts = watcher.run_once()
+        print(f'First pass: {counts} in {time.perf_counter() - start:.2f}s')
+        start = time.perf_counter()
+        counts = watcher.run_once()
+        print(f'No changes: {counts} in '
+              f'{1000 * (time.perf_counter() - start):.1f}ms')
+        path = os.path.join(folder, f'new-{names[-1]}')
+        shutil.copy(os.path.join('static', names[-1]), path)
+        os.utime(path, (past, past))
+        start = time.perf_counter()
+        counts = watcher.run_once()
+        print(f'One new page: {counts} in '
+              f'{1000 * (time.perf_counter() - start):.1f}ms')
+
+
+def position(chords=200, low=1, high=4):
+    ''' Compare candidate shapes per chord, and reading time, with and
+    without restricting the Guitarist to a position '''
+    song = random_song(int(chords), max_notes=2)
+    for window in (None, (int(low), int(high))):
+        g = player.Guitarist(position=window)
+        candidates = sum(len(g.voicings(chord)) for chord in song)
+        start = time.perf_counter()
+        g.read(song)
+        print(f'Position {window}: {candidates / len(song):.1f} shapes per '
+              f'chord, read in {time.perf_counter() - start:.2f}s')
+
+
+BENCHMARKS = {'memory': memory, 'song': song, 'optimize': optimize,
+              'segments': segments, 'storage': storage, 'midi': midi,
+              'engines': engines, 'position': position,
+              'checkpoints': checkpoints, 'kernels': kernels, 'table': table,
+              'instrument': instrumented, 'detect': detection, 'lines': lines,
+              'naming': naming, 'prefilter': prefilter, 'threads': threads,
+              'prefetch': prefetch, 'service': serving,
+              'watch': watching}
+
+
+if __name__ == '__main__':
+    try:
+        bench = BENCHMARKS[sys.argv[1]]
+    except (IndexError, KeyError):
+        print(f"Usage: python benchmark.py {{{'|'.join(BENCHMARKS)}}} [args...]")
+        sys.exit(1)
+    bench(*sys.argv[2:])
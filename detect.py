@@ -6,38 +6,54 @@ standard nomenclature of printed sheet music.
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-import itertools as it
+import hashlib
 import os
-import music, player
+import queue
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import instrument, music, player
 
 CWD = os.getcwd()
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'template', 'Q.png')
+CACHE_DIR = os.path.join(CWD, '.cache', 'detect')
+CACHE_BYTES = 64 * 2**20
+CACHE_VERSION = 1  # Increment whenever detection results would change
+# Detected notes: staff-relative position of each notehead, and match score
+PEAK_DTYPE = np.dtype([('x', np.int32), ('y', np.int32), ('score', np.float32)])
 
 
 class Controller():
-    def __init__(self, name, TEST=False):
+    def __init__(self, name, TEST=False, cache=None, low_memory=False,
+                 prefilter=False, threads=1, page=None):
         self.name = name
         if TEST:
             self.image_name = os.path.join('static', f'{name}.png')
         else:
             self.image_name = f'{name}.png'
-        self.main = StaffDetector(self.image_name)
+        self.main = StaffDetector(self.image_name, cache, low_memory, prefilter,
+                                  threads, page)
 
         # Calculate overlay sizing info
         self.radius = int(np.mean([s.note_size for s in self.main.staffs]))
         self.boldness = max(1, int(self.radius / 4))
 
         # Draw overlays and display image
-        self.copy = np.copy(self.main.image)
+        if self.main.image.ndim == 2:  # Decoded in grayscale
+            self.copy = cv2.cvtColor(self.main.image, cv2.COLOR_GRAY2BGR)
+        else:
+            self.copy = np.copy(self.main.image)
 #        self.show_lines(self.copy)
         self.show_boxes(self.copy)
         self.show_notes(self.copy)
         self.plot(self.copy)
 
         # Construct Song and transcribe into tablature
-        self.song = music.Song()
-        for staff in self.main.staffs:
-            for chord in staff.chords:
-                self.song.add(chord)
+        self.song = self.main.song()
         self.arr = player.Guitarist(self.song).arr
         print(f'{self.name}:\n{self.arr}')
 
@@ -58,12 +74,9 @@ class Controller():
 
     def show_notes(self, img):
         for staff in self.main.staffs:
-            H, W = staff.notes.shape[:2]
-#            radius = staff.note_size
-            for y, x in it.product(range(H), range(W)):
-                if staff.notes[y, x]:
-                    loc = tuple(np.add((x, y), staff.origin))
-                    cv2.circle(img, loc, self.radius, (0,0,255), self.boldness)
+            x0, y0 = staff.origin
+            for x, y in zip(staff.notes['x'].tolist(), staff.notes['y'].tolist()):
+                cv2.circle(img, (x + x0, y + y0), self.radius, (0,0,255), self.boldness)
 
     @staticmethod
     def detect_edges(img, sigma=0.33):
@@ -84,17 +97,53 @@ class Controller():
 
 
 class StaffDetector():
-    def __init__(self, name):
+    @instrument.timed('detect.StaffDetector')
+    def __init__(self, name, cache=None, low_memory=False, prefilter=False,
+                 threads=1, page=None):
+        ''' cache is an optional DetectionCache, consulted before detecting
+        anything, and updated with the results afterwards.
+        low_memory decodes the image straight to grayscale, which may differ
+        slightly from converting it from color, so self.image is the same
+        array as self.gray, and drops edge data once lines are found.
+        prefilter matches the note template only near notehead-sized blobs,
+        as found by NoteDetector.candidate_columns(), which may miss a few
+        faint notes that the full search would find.
+        threads is the number of staffs whose notes are detected at once,
+        in a pool of threads unless it is 1, or one per CPU if None. The
+        results, and their order, are the same either way.
+        page may hold the image already loaded, as from load_page() with the
+        same low_memory setting, e.g. by a PageLoader. '''
         # Pre-process image
         self.name = name
-        self.image = cv2.imread(name)
-        self.gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        self.prefilter = prefilter
+        if page is None:
+            page = load_page(name, low_memory)
+        data, self.image, self.gray = page
+        del page
+
+        # Skip straight to the results of a previous run, if possible
+        options = {'low_memory': True} if low_memory else {}
+        if prefilter:
+            options['prefilter'] = True
+        key = cache.key(data, **options) if cache is not None else None
+        del data
+        stored = cache.load(key) if cache is not None else None
+        self.cached = stored is not None
+        if cache is not None:
+            instrument.count('detect.cache_hits' if self.cached
+                             else 'detect.cache_misses')
+        if self.cached:
+            self.restore(stored)
+            return
+
         self.edges = cv2.Sobel(self.gray, ddepth=cv2.CV_8U, dx=0, dy=1, ksize=3)
 
         # Detect stafflines
         self.small_boxes = []
         self.staff_lines = []
         self.lines = self.hough_lines(self.edges)
+        if low_memory:
+            self.edges = None
         for staff in self.group_staffs(self.lines):
             self.staff_lines.append(staff)
             box = self.get_bounding_box(staff)
@@ -105,14 +154,90 @@ class StaffDetector():
         sizes = [abs(box[3] - box[1]) for box in self.small_boxes]
         self.staff_size = int(np.mean(sizes))
 
-        # Move on to phase 2: note detection
-        self.staffs = []
-        for n, lines, box in zip(range(100), self.staff_lines, self.large_boxes):
-            self.staffs.append(NoteDetector(self, n, lines, box))
+        # Move on to phase 2: note detection, which is independent per staff
+        self.staffs = self.detect_notes(threads)
+
+        if cache is not None:
+            cache.save(key, self.export())
 
     def __repr__(self):
         return f"StaffDetector('{self.name}')"
 
+    def song(self):
+        ''' Return a Song of every detected chord, staff by staff '''
+        return music.Song(chord for staff in self.staffs
+                          for chord in staff.chords)
+
+    def detect_notes(self, threads=1):
+        ''' Return a NoteDetector for each staff, in order. OpenCV releases
+        the GIL while matching and filtering, so staffs detected in a pool
+        of threads make use of multiple cores. '''
+        staffs = list(zip(range(100), self.staff_lines, self.large_boxes))
+        if threads == 1 or len(staffs) < 2:
+            return [NoteDetector(self, *staff) for staff in staffs]
+        with ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+            return list(pool.map(lambda staff: NoteDetector(self, *staff),
+                                 staffs))
+
+    def export(self):
+        ''' Return a dict of arrays holding every detection result '''
+        notes = [staff.notes for staff in self.staffs]
+        groups = [[len(g) for g in staff.chord_groups] for staff in self.staffs]
+        chords = [[note.value for note in chord.notes]
+                  for staff in self.staffs for chord in staff.chords]
+        return {
+            'lines': np.array(self.lines, dtype=np.int32).reshape(-1, 4),
+            'staff_lines': np.array([line for staff in self.staff_lines
+                                     for line in staff], np.int32).reshape(-1, 4),
+            'lines_per_staff': [len(staff) for staff in self.staff_lines],
+            'small_boxes': np.array(self.small_boxes, np.int32).reshape(-1, 4),
+            'large_boxes': np.array(self.large_boxes, np.int32).reshape(-1, 4),
+            'staff_size': self.staff_size,
+            'notes_per_staff': [len(n) for n in notes],
+            'note_points': np.concatenate(  # As (y, x) rows
+                [np.stack((n['y'], n['x']), axis=1) for n in notes]
+                + [np.empty((0, 2))]).astype(np.int32),
+            'note_scores': np.concatenate(
+                [n['score'] for n in notes] + [[]]).astype(np.float32),
+            'groups_per_staff': [len(g) for g in groups],
+            'group_sizes': np.array([n for g in groups for n in g], np.int32),
+            'chords_per_staff': [len(staff.chords) for staff in self.staffs],
+            'chord_sizes': np.array([len(c) for c in chords], np.int32),
+            'chord_values': np.array([v for c in chords for v in c],
+                                     music.VALUE_DTYPE),
+        }
+
+    def restore(self, data):
+        ''' Set detection results from a dict of arrays, as from export() '''
+        def split(array, counts):
+            bounds = np.cumsum([0, *counts]).tolist()
+            return [array[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+        self.lines = tuple(data['lines'].tolist())
+        self.staff_lines = [lines.tolist() for lines in split(
+            data['staff_lines'], data['lines_per_staff'])]
+        self.small_boxes = [tuple(box) for box in data['small_boxes'].tolist()]
+        self.large_boxes = [tuple(box) for box in data['large_boxes'].tolist()]
+        self.staff_size = int(data['staff_size'])
+
+        notes = zip(split(data['note_points'], data['notes_per_staff']),
+                    split(data['note_scores'], data['notes_per_staff']))
+        groups = split(data['group_sizes'], data['groups_per_staff'])
+        chord_sizes = split(data['chord_sizes'], data['chords_per_staff'])
+        values = split(data['chord_values'], [sum(c) for c in chord_sizes])
+        self.staffs = []
+        for n, lines, box in zip(range(100), self.staff_lines, self.large_boxes):
+            points, scores = next(notes)
+            peaks = make_peaks(points[:, 1], points[:, 0], scores)
+            # Chord groups contain (x, y) points, sorted as by group_chords
+            points = sorted((x, y) for y, x in points.tolist())
+            chord_groups = split(points, groups[n])
+            chords = [music.make_chord(tuple(v.tolist())) for v in
+                      split(values[n], chord_sizes[n])]
+            self.staffs.append(NoteDetector(
+                self, n, lines, box, cached=(peaks, chord_groups, chords)))
+
+    @instrument.timed('detect.hough_lines')
     def hough_lines(self, image):
         ''' Detect lines in image using the probabilistic Hough transform '''
         hough = cv2.HoughLinesP(image, rho=1, theta=np.pi/360, threshold=400,
@@ -121,58 +246,46 @@ class StaffDetector():
         return self.filter_lines(hough)
 
     def filter_lines(self, lines):
-        temp = []
+        ''' Return a tuple of the nearly horizontal lines, [x1, y1, x2, y2],
+        from HoughLinesP output, sorted by y1. Lines within 5 pixels of the
+        previous one are dropped as duplicates. '''
         if lines is None: return ()
-        for line in lines.tolist():
-            x1, y1, x2, y2 = line[0]
-            try:
-                slope = abs((y2 - y1) / (x2 - x1))
-                if slope < 0.01:
-                    temp.append(line[0])
-            except ZeroDivisionError:
-                continue
-        temp.sort(key=lambda x: x[1])
+        lines = np.asarray(lines).reshape(-1, 4)
+        dx = lines[:, 2] - lines[:, 0]
+        dy = lines[:, 3] - lines[:, 1]
+        lines, dx, dy = lines[dx != 0], dx[dx != 0], dy[dx != 0]
+        lines = lines[np.abs(dy / dx) < 0.01]
+        lines = lines[np.argsort(lines[:, 1], kind='stable')]
         # Remove duplicates
-        for a, b in zip(temp[:-1], temp[1:]):
-            if abs(a[1] - b[1]) < 5:
-                temp.remove(b)
-        return tuple(temp)
+        keep = np.ones(len(lines), bool)
+        keep[1:] = np.abs(np.diff(lines[:, 1])) >= 5
+        return tuple(lines[keep].tolist())
 
     def group_staffs(self, lines):
         ''' Return list of lists containing the lines of each staff entity
         Enforces a maximum of double the median line distance within groups'''
         if len(lines) == 0: return [[]]
-        lines = sorted(lines, key=lambda x: (x[1]+x[3])/2)
+        lines = np.asarray(lines).reshape(-1, 4)
+        centers = (lines[:, 1] + lines[:, 3]) / 2
+        lines = lines[np.argsort(centers, kind='stable')]
+        if len(lines) == 1: return [lines.tolist()]
         # Measure line spacing (from the center) and determine threshold
-        spacing = []
-        for a, b in zip(lines[:-1], lines[1:]):
-            spacing.append(int((b[1]+b[3])/2 - (a[1]+a[3])/2))
+        spacing = np.diff(np.sort(centers, kind='stable')).astype(int)
         thresh = 2 * np.median(spacing)
         # Start new group when spacing gets too large
-        staffs = []
-        temp = [lines[0]]
-        for line, dist in zip(lines[1:], spacing):
-            if dist < thresh:
-                temp.append(line)
-            else:
-                staffs.append(temp[:])
-                temp = [line]
-        staffs.append(temp)
-        return staffs
+        breaks = np.flatnonzero(~(spacing < thresh)) + 1
+        return [staff.tolist() for staff in np.split(lines, breaks)]
 
     def get_bounding_box(self, lines):
         ''' Return corner coordinates of rectangle surrounding given lines
         lines is a list of 4-tuples of the form (x1, y1, x2, y2)
         Currently ignores everything outside the stafflines themselves
         Will need to expand to account for ledger lines'''
-        try:
-            min_x = min(min(line[0], line[2]) for line in lines)
-            max_x = max(max(line[0], line[2]) for line in lines)
-            min_y = min(min(line[1], line[3]) for line in lines)
-            max_y = max(max(line[1], line[3]) for line in lines)
-            return (min_x, min_y, max_x, max_y)
-        except ValueError:
+        lines = np.asarray(lines).reshape(-1, 4)
+        if len(lines) == 0:
             return ()
+        xs, ys = lines[:, 0::2], lines[:, 1::2]
+        return (int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
 
     def expand_boxes(self, boxes):
         ''' Stretch adajcent staff boxes together to capture ledger lines
@@ -197,7 +310,11 @@ class StaffDetector():
 
 
 class NoteDetector():
-    def __init__(self, parent, n, lines, box):
+    @instrument.timed('detect.NoteDetector')
+    def __init__(self, parent, n, lines, box, cached=None):
+        ''' cached may hold previous results: (notes, chord_groups, chords).
+        notes is a PEAK_DTYPE array of each detected notehead, sorted by
+        x, then y, relative to the staff's origin. '''
         self.parent = parent
         self.n = n
         self.lines = lines
@@ -205,87 +322,141 @@ class NoteDetector():
         self.origin = (min(box[0], box[2]), min(box[1], box[3]))  # (x, y)
         self.image = self.subarray(self.parent.image, box)
         self.gray = self.subarray(self.parent.gray, box)
-
         self.note_size = int(self.parent.staff_size / 4)
-        q = cv2.imread('template/Q.png', cv2.IMREAD_GRAYSCALE)
+        if cached is not None:
+            self.notes, self.chord_groups, self.chords = cached
+            return
+
+        q = cv2.imread(TEMPLATE, cv2.IMREAD_GRAYSCALE)
         scale = self.note_size / q.shape[0]
         self.q = cv2.resize(q, None, fx=scale, fy=scale, )
 
         # Find and group notes
         note_blobs = self.find_notes()
-        self.notes = self.filter_local_maxima(note_blobs, self.note_size)
+        self.notes = self.find_peaks(note_blobs, self.note_size)
+        del note_blobs
         self.chord_groups = self.group_chords(self.notes)
 
         # Assign names to found notes
         key = (min(i[1] for i in self.lines) - self.origin[1],
                max(i[1] for i in self.lines) - self.origin[1])
-        named_groups = [self.name_notes(i, key) for i in self.chord_groups]
-        try: self.chords = [music.Chord([*chord]) for chord in named_groups]
+        values = self.pitch_values(self.notes['y'], key)
+        sizes = [len(group) for group in self.chord_groups]
+        groups = np.split(values, np.cumsum(sizes)[:-1])
+        try: self.chords = [music.make_chord(tuple(sorted(set(g.tolist()))))
+                            for g in groups]
         except ValueError: self.chords = []
 
     def find_notes(self):
-        matches= cv2.matchTemplate(self.gray, self.q, cv2.TM_CCOEFF_NORMED)
-        thresh = np.max(matches) * (1 - 1.5 * np.std(matches))
-        matches = np.where(matches < 0.5, 0, matches)
+        ''' Return a float32 array of template match scores, centered on
+        each match, with weak matches set to 0. Thresholds are applied in
+        place, to avoid full size copies. '''
+        instrument.count('detect.template_matches')
+        if self.parent.prefilter:
+            matches, searched = self.match_candidates()
+        else:
+            with instrument.timer('detect.matchTemplate'):
+                matches= cv2.matchTemplate(self.gray, self.q, cv2.TM_CCOEFF_NORMED)
+            searched = matches
+        thresh = np.max(searched) * (1 - 1.5 * np.std(searched))
+        del searched
+        matches[matches < 0.5] = 0
         # Shift matches, to locate centerpoint instead of top-left corner
         offset = int(self.note_size/2)
-        points = np.zeros(matches.shape)
+        points = np.zeros(matches.shape, np.float32)
         points[offset:, offset:] = matches[:-offset, :-offset]
-        return np.where(points > thresh, points, 0)
+        del matches
+        points[~(points > thresh)] = 0
+        return points
+
+    def candidate_columns(self):
+        ''' Return a list of [x0, x1) column ranges of the staff which may
+        hold noteheads. Staff lines and stems are removed from the binarized
+        staff by a morphological opening, then each remaining blob no wider
+        than a few notes is padded by the template width on either side,
+        and overlapping ranges are merged. '''
+        size = self.note_size
+        _, ink = cv2.threshold(self.gray, 0, 255,
+                               cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+        k = max(1, size // 2)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k, k))
+        heads = cv2.morphologyEx(ink, cv2.MORPH_OPEN, kernel, dst=ink)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(heads, connectivity=8)
+        stats = stats[1:]  # Skip the background
+        blobs = stats[(stats[:, cv2.CC_STAT_WIDTH] <= 3 * size)
+                      & (stats[:, cv2.CC_STAT_AREA] >= size * size / 8)]
+        pad = self.q.shape[1]
+        width = self.gray.shape[1]
+        columns = []
+        for x, w in sorted(blobs[:, [cv2.CC_STAT_LEFT, cv2.CC_STAT_WIDTH]].tolist()):
+            x0, x1 = max(0, x - pad), min(width, x + w + pad)
+            if columns and x0 <= columns[-1][1]:
+                columns[-1][1] = max(columns[-1][1], x1)
+            else:
+                columns.append([x0, x1])
+        instrument.count('detect.candidate_columns', len(columns))
+        return [(x0, x1) for x0, x1 in columns if x1 - x0 >= pad]
+
+    def match_candidates(self):
+        ''' Return template match scores for the whole staff, as from
+        cv2.matchTemplate, but computed only within candidate_columns(),
+        and 0 elsewhere, plus a 1D array of only the computed scores '''
+        h, w = self.q.shape
+        matches = np.zeros((self.gray.shape[0] - h + 1,
+                            self.gray.shape[1] - w + 1), np.float32)
+        searched = np.zeros(matches.shape[1], bool)
+        with instrument.timer('detect.matchTemplate'):
+            for x0, x1 in self.candidate_columns():
+                matches[:, x0:x1 - w + 1] = cv2.matchTemplate(
+                    self.gray[:, x0:x1], self.q, cv2.TM_CCOEFF_NORMED)
+                searched[x0:x1 - w + 1] = True
+        if not searched.any():
+            return matches, np.zeros(1, np.float32)
+        return matches, matches[:, searched].ravel()
 
     def filter_local_maxima(self, array, ksize):
         ''' Sharpen relative peaks of array to a single local maximum
         within each ksize * ksize neighborhood '''
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (ksize, ksize))
         dilated = cv2.dilate(array, kernel)
-        return np.where(dilated == array, array, 0)
-
-    def group_chords(self, array):
-        ''' Takes a boolean array representing presence of a note at [y, x]
+        dilated[dilated != array] = 0  # Reuse it for the result
+        return dilated
+
+    def find_peaks(self, array, ksize):
+        ''' Return a PEAK_DTYPE array of the local maxima of array, as kept
+        by filter_local_maxima(), sorted by x, then y '''
+        maxima = self.filter_local_maxima(array, ksize)
+        y, x = np.nonzero(maxima)
+        return make_peaks(x, y, maxima[y, x])
+
+    def group_chords(self, peaks):
+        ''' Takes a PEAK_DTYPE array of notes, sorted by x, then y
         Returns a list of lists of note coordinates, [[(x,y), ...], ...],
         with each sublist group containing simultaneous notes, i.e. a chord '''
-        # Extract coordinates from array
-        notes = []
-        for y, x in it.product(range(array.shape[0]), range(array.shape[1])):
-            if array[y, x] and (x, y) not in notes:
-                notes.append((x, y))
-        if len(notes) == 0:
+        if len(peaks) == 0:
             return [[]]
-        notes.sort()
-
         # Group points by x-proximity, indicating simultanaeity
-        groups = []
-        temp = [notes[0]]
-        for note in notes[1:]:
-            if abs(note[0] - temp[-1][0]) <= self.note_size:
-                temp.append(note)
-            else:
-                groups.append(temp)
-                temp = [note]
-        groups.append(temp)
-        return groups
+        xs = peaks['x'].astype(np.int64)
+        breaks = np.flatnonzero(np.diff(xs) > self.note_size) + 1
+        points = list(zip(xs.tolist(), peaks['y'].tolist()))
+        bounds = [0, *breaks.tolist(), len(points)]
+        return [points[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
 
     def name_notes(self, points, key):
         ''' Converts a list of (x, y) coordinate values into named Notes
         key should contain top/bottom staffline y-values, for F5 and E4 '''
+        values = self.pitch_values([y for _, y in points], key)
+        return [music.Note(value) for value in values.tolist()]
+
+    def pitch_values(self, ys, key):
+        ''' Return an array of the pitch values of notes at an array of
+        y-values, rounded to the nearest line or space, with key as above '''
         e4 = max(key)
         f5 = min(key)
         step = (e4 - f5) / 8
         c4 = e4 + int(2 * step)
-        names = []
-        for point in points:
-            steps = round((point[1] - c4) / step)
-            if steps == 0:
-                names.append(music.Note('C4'))
-                continue
-            # Probably want to link these to the music module
-            elif steps > 0: scale = 'BAGFEDC'
-            elif steps < 0: scale = 'DEFGABC'
-            for i, _ in zip(it.cycle(scale), range(abs(steps))):
-                name = i
-            octave = str(3 - ((steps-1) // 7))  # Octaves increment at C
-            names.append(music.Note(name + octave))
-        return names
+        steps = np.rint((np.asarray(ys) - c4) / step)  # Downwards from C4
+        return music.diatonic_values(-steps)
 
     def subarray(self, image, corners):
         ''' Return image subarray bounded by box corners: (x0, y0, x1, y1)'''
@@ -294,10 +465,199 @@ class NoteDetector():
         return image[y0:y1, x0:x1]
 
 
+def load_page(name, low_memory=False):
+    ''' Return the (data, image, gray) of an image file, where data is its
+    encoded bytes, as from decode_page() '''
+    with instrument.timer('detect.load_page'):
+        with open(name, 'rb') as f:
+            return decode_page(f.read(), low_memory)
+
+
+def decode_page(data, low_memory=False):
+    ''' Return (data, image, gray) for the bytes of an encoded image. With
+    low_memory, image is decoded straight to grayscale, and is the same
+    array as gray. Raises ValueError if data is not an image. '''
+    buffer = np.frombuffer(data, np.uint8)
+    if not buffer.size:
+        raise ValueError('No image data')
+    if low_memory:
+        gray = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError('Could not decode image')
+        return data, gray, gray
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image')
+    return data, image, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+class PageLoader():
+    ''' Iterates over (name, page) pairs for a list of image files, with each
+    page as from load_page(). A background thread reads and decodes up to
+    ahead pages while the caller detects the last one, which overlaps disk
+    and decoding time with detection, since both release the GIL.
+    Records the number of pages ready as each one was requested, and the
+    time the caller spent waiting for pages, and the loader for room. '''
+    def __init__(self, names, ahead=2, low_memory=False):
+        self.names = list(names)
+        self.ahead = ahead
+        self.low_memory = low_memory
+        self.depths = []  # Pages waiting in the queue, as each was requested
+        self.stalled = 0  # Seconds the caller waited for pages
+        self.blocked = 0  # Seconds the loader waited for the caller
+        self.loading = 0  # Seconds spent reading and decoding
+
+    def __repr__(self):
+        return f'PageLoader({len(self.names)} pages, ahead={self.ahead})'
+
+    def __iter__(self):
+        pages = queue.Queue(self.ahead)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._load, args=(pages, stop),
+                                  daemon=True)
+        thread.start()
+        try:
+            for _ in self.names:
+                self.depths.append(pages.qsize())
+                start = time.perf_counter()
+                with instrument.timer('detect.prefetch_stall'):
+                    name, page, error = pages.get()
+                self.stalled += time.perf_counter() - start
+                if error is not None:
+                    raise error
+                yield name, page
+        finally:
+            # Unblock the loader if the caller stopped early
+            stop.set()
+            while thread.is_alive():
+                try: pages.get(timeout=0.01)
+                except queue.Empty: pass
+
+    def _load(self, pages, stop):
+        for name in self.names:
+            if stop.is_set():
+                return
+            start = time.perf_counter()
+            try:
+                item = (name, load_page(name, self.low_memory), None)
+            except Exception as error:
+                item = (name, None, error)
+            loaded = time.perf_counter()
+            self.loading += loaded - start
+            pages.put(item)
+            self.blocked += time.perf_counter() - loaded
+            if item[2] is not None:
+                return
+
+    def report(self):
+        ''' Return a dict summarizing the queue and its waiting times '''
+        depths = self.depths or [0]
+        return {'pages': len(self.depths), 'ahead': self.ahead,
+                'mean_depth': sum(depths) / len(depths),
+                'empty': depths.count(0), 'stalled': self.stalled,
+                'blocked': self.blocked, 'loading': self.loading}
+
+
+def make_peaks(x, y, score):
+    ''' Return a PEAK_DTYPE array of notes from arrays of their x and y
+    positions and scores, sorted by x, then y '''
+    peaks = np.empty(len(x), PEAK_DTYPE)
+    peaks['x'], peaks['y'], peaks['score'] = x, y, score
+    return peaks[np.lexsort((peaks['y'], peaks['x']))]
+
+
+class DetectionCache():
+    ''' A directory of detection results, stored as one .npz file per page,
+    and named by a hash of the image, the note template, and any detector
+    parameters, so changing any of them results in a fresh detection.
+    The least recently used files are deleted once max_bytes is exceeded.'''
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_BYTES, **params):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.params = dict(params, version=CACHE_VERSION)
+        with open(TEMPLATE, 'rb') as f:
+            self.template = f.read()
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return f"DetectionCache('{self.path}')"
+
+    def key(self, data, **options):
+        ''' Return a hex digest identifying image bytes data, detected
+        with any options which would change the results '''
+        h = hashlib.sha256(data)
+        h.update(self.template)
+        h.update(repr(sorted(dict(self.params, **options).items())).encode())
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, f'{key}.npz')
+
+    def load(self, key):
+        ''' Return a dict of stored arrays, or None if key is not present.
+        Unreadable files, such as those truncated by a full disk, are
+        deleted and treated as not present. '''
+        name = self.filename(key)
+        try:
+            # Opened here, so it is closed even if np.load fails, and may
+            # then be deleted on Windows too
+            with open(name, 'rb') as f:
+                data = dict(np.load(f, allow_pickle=False))
+            os.utime(name)  # Mark as recently used
+        except FileNotFoundError:  # Perhaps evicted by another process
+            return None
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile, zlib.error):
+            try: os.remove(name)
+            except OSError: pass
+            return None
+        return data
+
+    def save(self, key, data):
+        ''' Store a dict of arrays under key, then enforce the size limit '''
+        # A temporary file of its own, as other processes may save the same
+        # key at once, moved into place whole so files are never partial
+        fd, temp = tempfile.mkstemp('.tmp', key, self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **data)
+            os.replace(temp, self.filename(key))
+        except BaseException:
+            os.remove(temp)
+            raise
+        self.evict()
+
+    def evict(self):
+        ''' Delete least recently used files until within max_bytes '''
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                try: stat = entry.stat()
+                except FileNotFoundError: continue  # Deleted by another
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try: os.remove(path)
+            except FileNotFoundError: pass  # Another process got there first
+            total -= size
+
+
 if __name__ == '__main__':
+    # Usage: python -i detect.py [stats.json], to also save timings there
+    import sys
+    stats = instrument.enable() if len(sys.argv) > 1 else None
     detectors = []
-    for filename in os.listdir():
-        if filename[-4:] == '.png':  # There is a better way to do this
-            detectors.append(Controller(filename[:-4]))
-
-    Controller.plot(detectors[0].main.staffs[0].notes)
+    cache = DetectionCache()
+    loader = PageLoader(f for f in sorted(os.listdir()) if f[-4:] == '.png')
+    for filename, page in loader:
+        detectors.append(Controller(filename[:-4], cache=cache, page=page))
+    if stats is not None:
+        print(stats)
+        print(loader.report())
+        stats.save(sys.argv[1])
+
+    staff = detectors[0].main.staffs[0]
+    notes = np.zeros(staff.gray.shape, np.float32)
+    notes[staff.notes['y'], staff.notes['x']] = staff.notes['score']
+    Controller.plot(notes)
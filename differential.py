@@ -0,0 +1,340 @@
+'''
+This file concerns differential testing of the optimized paths of the
+other modules against the straightforward code they stand in for, on
+random chords and songs and on the static/ pages, with the speedup of each.
+
+Every check compares a candidate with its reference on the same cases,
+timing each over all of them. Exact candidates must match the reference on
+every case, or, where noted, do at least as well. Approximate candidates,
+such as the detection prefilter, only have their differences reported.
+
+Usage: python differential.py [seed] [scale]
+Exits with status 1 if any exact candidate differs from its reference.
+'''
+
+import itertools as it
+import os
+import random
+import reprlib
+import sys
+import tempfile
+import time
+import numpy as np
+import music, player, tab
+
+EXAMPLES = 3  # Differences described per check
+_repr = reprlib.Repr()
+_repr.maxlist = _repr.maxtuple = _repr.maxset = 8
+
+
+class Result():
+    ''' The outcome of comparing a candidate with its reference '''
+    def __init__(self, name, exact=True):
+        self.name = name
+        self.exact = exact
+        self.cases = 0
+        self.different = 0
+        self.better = 0  # Cases where the candidate beat the reference
+        self.examples = []  # Descriptions of the first few differences
+        self.reference_time = 0.0
+        self.candidate_time = 0.0
+
+    def __repr__(self):
+        if not self.different:
+            status = 'same'
+        else:
+            status = f'{self.different} different'
+            if not self.exact:
+                status += ' (approximate)'
+        if self.better:
+            status += f', {self.better} better'
+        return (f'{self.name}: {self.cases} cases, {status}, '
+                f'{self.speedup:.1f}x speedup '
+                f'({self.reference_time:.3f}s vs {self.candidate_time:.3f}s)')
+
+    @property
+    def ok(self):
+        return not self.exact or not self.different
+
+    @property
+    def speedup(self):
+        try: return self.reference_time / self.candidate_time
+        except ZeroDivisionError: return float('inf')
+
+
+def compare(name, cases, reference, candidate, better=None, exact=True):
+    ''' Return a Result comparing reference(cases) with candidate(cases),
+    each returning a list of one output per case. better(expected, found)
+    may accept some differing outputs as improvements. '''
+    result = Result(name, exact)
+    start = time.perf_counter()
+    expected = reference(cases)
+    result.reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    found = candidate(cases)
+    result.candidate_time = time.perf_counter() - start
+    result.cases = len(cases)
+    for case, a, b in zip(cases, expected, found):
+        if a == b:
+            continue
+        if better is not None and better(a, b):
+            result.better += 1
+            continue
+        result.different += 1
+        if len(result.examples) < EXAMPLES:
+            result.examples.append(f'{_repr.repr(case)}: expected '
+                                   f'{_repr.repr(a)}, found {_repr.repr(b)}')
+    return result
+
+
+def random_song(length, seed=0, max_notes=3):
+    ''' Return a Song of length random Chords, each built from an actual
+    fretboard shape so that every chord is guaranteed to be playable '''
+    rng = random.Random(seed)
+    song = music.Song()
+    for _ in range(length):
+        base = rng.randint(0, 9)
+        strings = rng.sample(range(6), rng.randint(1, max_notes))
+        values = [music.LOW_E + music.STD_TUNING[s] + rng.randint(base, base+3)
+                  for s in strings]
+        song.add(music.Chord(values, rng.choice((1/8, 1/4, 1/2))))
+    return song
+
+
+# Songs for tests and benchmarks: E major, Smoke on the Water, Blackbird
+TEST_SONGS = {
+    'scale': [(['E3'], 1/8), (['F#3'], 1/8), (['G#3'], 1/8), (['A3'], 1/8),
+              (['B3'], 1/8), (['C#4'], 1/8), (['D#4'], 1/8), (['E4'], 1/8)],
+    'smoke': [(['E3', 'B3', 'E4'], 1/4), (['G3', 'D4', 'G4'], 1/4),
+              (['A3', 'E4', 'A4'], 3/8), (['E3', 'B3', 'E4'], 1/4),
+              (['G3', 'D4', 'G4'], 1/4), (['B3', 'F#4', 'B4'], 1/8),
+              (['A3', 'E4', 'A4'], 1/2)],
+    'blackbird': [(['G3', 'B4'], 1/6), (['G4'], 1/6), (['A3', 'C5'], 1/6),
+                  (['G4'], 1/6), (['B3', 'D5'], 1/6), (['G4'], 1/6),
+                  (['G4', 'B5'], 1/4), (['G4'], 1/8), (['B5'], 1/8),
+                  (['G4'], 1/8), (['B5'], 1/8), (['G4'], 1/4)]}
+
+
+def test_songs():
+    return {name: music.Song([music.Chord(*chord) for chord in chords])
+            for name, chords in TEST_SONGS.items()}
+
+
+def random_values(rng, max_notes=4):
+    ''' Return a sorted tuple of distinct pitch values, which may or may
+    not be playable together '''
+    low = music.LOW_E
+    notes = rng.randint(1, max_notes)
+    return tuple(sorted(rng.sample(range(low, low + 24 + music.MAX_FRET), notes)))
+
+
+def reference_voicings(values, tuning=music.STD_TUNING, capo=0):
+    ''' Return the set of fret-lists playing every pitch value, by trying
+    each assignment of the notes to different strings '''
+    found = set()
+    for strings in it.permutations(range(6), len(values)):
+        frets = [None] * 6
+        for string, value in zip(strings, values):
+            fret = value - music.LOW_E - tuning[string] - capo
+            if not 0 <= fret <= music.MAX_FRET - capo:
+                break
+            frets[string] = fret
+        else:
+            fretted = [f for f in frets if f]
+            if not fretted or max(fretted) - min(fretted) <= music.MAX_SPAN:
+                found.add(tuple(frets))
+    return found
+
+
+def check_voicings(chords=300, seed=0):
+    ''' Chord shapes, in random tunings and capo positions, against every
+    assignment of notes to strings '''
+    rng = random.Random(seed)
+    cases = [(random_values(rng), rng.choice(player.TUNINGS), rng.randint(0, 4))
+             for _ in range(int(chords))]
+
+    def candidate(cases):
+        music.get_voicings.cache_clear()  # As used by Chord.get_shapes
+        return [{tuple(s.list_frets()) for s in
+                 music.get_voicings(values, tuple(tuning), capo)}
+                for values, tuning, capo in cases]
+
+    return compare('Chord shapes (get_voicings)', cases,
+                   lambda cases: [reference_voicings(*case) for case in cases],
+                   candidate)
+
+
+def check_positions(chords=300, seed=0):
+    ''' VoicingIndex queries for hand positions, against filtering every
+    shape of each chord in turn '''
+    rng = random.Random(seed)
+    cases = []
+    for _ in range(int(chords)):
+        low = rng.randint(1, 12)
+        cases.append((random_values(rng, 3), (low, low + rng.randint(2, 4))))
+
+    def reference(cases):
+        found = []
+        for values, (low, high) in cases:
+            shapes = music.get_voicings(values)
+            fits = [s for s in shapes if all(
+                not f or low <= f <= high for f in s.list_frets() if f is not None)]
+            found.append([tuple(s.list_frets()) for s in fits or shapes])
+        return found
+
+    def candidate(cases):
+        return [[tuple(s.list_frets()) for s in
+                 music.Chord(list(values)).get_shapes(position=position)]
+                for values, position in cases]
+
+    for values, _ in cases:  # Voice every chord before timing either
+        music.get_voicing_index(values)
+    return compare('VoicingIndex.query', cases, reference, candidate)
+
+
+def random_moves(moves=2000, seed=0):
+    ''' Return a list of (packed Hand state, Shape) pairs along a random
+    walk, including barres, slides to the nut and frets which slide out
+    of the packable range '''
+    rng = random.Random(seed)
+    hand = player.Hand()
+    state = hand.state
+    pairs = []
+    for _ in range(int(moves)):
+        frets = [rng.choice((None, None, 0, rng.randint(1, 20)))
+                 for _ in range(6)]
+        shape = tab.Shape(frets if any(f is not None for f in frets)
+                          else [3] + frets[1:])
+        pairs.append((state, shape))
+        hand.restore(state)
+        hand.move(shape)
+        try: state = hand.state
+        except ValueError: state = 0
+    return pairs
+
+
+def reference_steps(pairs):
+    ''' Return (difficulty, new state) of each move by Hand.move, with a
+    new state of -1 where it can't be packed '''
+    hand = player.Hand()
+    found = []
+    for state, shape in pairs:
+        hand.restore(state)
+        cost = hand.move(shape) + hand.strain
+        try: found.append((cost, hand.state))
+        except ValueError: found.append((cost, -1))
+    return found
+
+
+def check_steps(moves=2000, seed=0, table=None):
+    ''' Step kernels, and the step table if it has been built, or the
+    given StepTable, against Hand.move and Hand.strain '''
+    pairs = random_moves(moves, seed)
+    kernels = {'numpy': player.score_steps_numpy,
+               'loop': player.score_steps_loop}
+    if player.numba:
+        player.score_steps(np.zeros(1, np.int64), np.zeros((1, 6), np.int64))
+        kernels['numba'] = player.score_steps
+    results = []
+    for name, kernel in kernels.items():
+        def candidate(pairs, kernel=kernel):
+            states = np.array([state for state, _ in pairs], np.int64)
+            costs, new = kernel(states, player.shape_frets(
+                [shape for _, shape in pairs]))
+            return list(zip(costs.tolist(), new.tolist()))
+        results.append(compare(f'score_steps ({name})', pairs,
+                               reference_steps, candidate))
+    if table is None:
+        table = player.get_table()
+    if table is not None:
+        results.append(check_table(table, moves, seed))
+    return results
+
+
+def check_table(table, moves=2000, seed=0):
+    ''' StepTable lookups against Hand.move and Hand.strain, for random
+    moves between the nearby shapes it holds '''
+    rng = random.Random(seed)
+    shapes = [tab.Shape([None if f < 0 else f for f in row])
+              for row in table.frets.tolist()]
+    pairs = []
+    for _ in range(int(moves)):
+        i = rng.randrange(len(shapes))
+        j = table.dest[rng.randrange(table.indptr[i], table.indptr[i+1])]
+        pairs.append((int(table.states[i]), shapes[j]))
+    return compare('StepTable.lookup', pairs, reference_steps,
+                   lambda pairs: [table.lookup(state, tuple(shape.list_frets()))
+                                  for state, shape in pairs])
+
+
+def check_engines(songs=10, length=10, seed=0):
+    ''' Scores of the astar and dp engines against those of the product
+    engine, which plays every path. Lower scores count as better. '''
+    cases = [random_song(int(length), seed + i, max_notes=2)
+             for i in range(int(songs))]
+
+    def engine(name):
+        return lambda cases: [player.Guitarist(song, engine=name).score
+                              for song in cases]
+
+    return [compare(f'Guitarist (engine={name!r})', cases, engine('product'),
+                    engine(name), better=lambda a, b: b < a)
+            for name in player.ENGINES if name != 'product']
+
+
+def detected_chords(detector):
+    ''' Return the pitch values of every detected chord, by staff '''
+    return [[tuple(note.value for note in chord.notes) for chord in staff.chords]
+            for staff in detector.staffs]
+
+
+def check_detection(pages=None):
+    ''' Detected chords of each static page, with each detection option
+    and from the cache, against the default detector '''
+    import detect
+    if pages is None:
+        pages = sorted(os.path.join('static', f) for f in os.listdir('static'))
+
+    def detect_with(**options):
+        return lambda pages: [detected_chords(detect.StaffDetector(page, **options))
+                              for page in pages]
+
+    reference = detect_with()
+    results = [compare('StaffDetector (low_memory)', pages, reference,
+                       detect_with(low_memory=True)),
+               compare('StaffDetector (threads=4)', pages, reference,
+                       detect_with(threads=4)),
+               compare('StaffDetector (prefilter)', pages, reference,
+                       detect_with(prefilter=True), exact=False)]
+    with tempfile.TemporaryDirectory() as folder:
+        cache = detect.DetectionCache(folder)
+        detect_with(cache=cache)(pages)  # Fill the cache
+        results.append(compare('StaffDetector (cached)', pages, reference,
+                               detect_with(cache=cache)))
+    return results
+
+
+def run(seed=0, scale=1):
+    ''' Run every check, printing each Result as it finishes, and return
+    them all. scale multiplies the number of random cases. '''
+    checks = [lambda: check_voicings(300 * scale, seed),
+              lambda: check_positions(300 * scale, seed),
+              lambda: check_steps(2000 * scale, seed),
+              lambda: check_engines(10 * scale, 10, seed),
+              check_detection]
+    results = []
+    for check in checks:
+        found = check()
+        for result in found if isinstance(found, list) else [found]:
+            print(result, flush=True)
+            for example in result.examples:
+                print(f'    {example}')
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    scale = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    results = run(seed, scale)
+    sys.exit(0 if all(result.ok for result in results) else 1)
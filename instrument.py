@@ -0,0 +1,168 @@
+'''
+This file concerns optional measurement of where time goes in each stage of
+detection, arranging and transcription, via named timers and counters. It
+is disabled by default, when instrumented code costs only a flag check.
+
+Usage:
+    with instrument.collect() as stats:
+        Controller('page')
+    print(stats)
+    stats.save('stats.json')
+
+Only the current process is measured, so work sent to process pools, e.g.
+by Guitarist(processes=2) or player.optimize(), is not counted.
+'''
+
+import contextlib
+import functools
+import json
+import threading
+import time
+
+ENABLED = False
+
+
+class Stats():
+    ''' Totals of named timers, as [calls, seconds], and named counters.
+    Updates are locked, so threads may share one Stats object. '''
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        lines = [f'{name}: {calls} calls, {seconds:.4f}s'
+                 for name, (calls, seconds) in sorted(
+                     self.timers.items(), key=lambda item: -item[1][1])]
+        lines += [f'{name}: {count}'
+                  for name, count in sorted(self.counters.items())]
+        return '\n'.join(lines)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            try:
+                total = self.timers[name]
+            except KeyError:
+                total = self.timers[name] = [0, 0.0]
+            total[0] += 1
+            total[1] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        ''' Add the totals of another Stats object to these. Each is locked
+        in turn, never both at once, so merging can't deadlock. '''
+        with other.lock:
+            timers = [(name, calls, seconds)
+                      for name, (calls, seconds) in other.timers.items()]
+            counters = list(other.counters.items())
+        with self.lock:
+            for name, calls, seconds in timers:
+                total = self.timers.setdefault(name, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+            for name, count in counters:
+                self.counters[name] = self.counters.get(name, 0) + count
+
+    def report(self):
+        ''' Return a JSON-compatible dict of every timer and counter '''
+        with self.lock:
+            return {'timers': {name: {'calls': calls, 'seconds': seconds}
+                               for name, (calls, seconds) in self.timers.items()},
+                    'counters': dict(self.counters)}
+
+    def save(self, path):
+        ''' Write report() to path as JSON '''
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        ''' Read a Stats object from a report written by save() '''
+        with open(path) as f:
+            report = json.load(f)
+        stats = cls()
+        for name, total in report['timers'].items():
+            stats.timers[name] = [total['calls'], total['seconds']]
+        stats.counters.update(report['counters'])
+        return stats
+
+
+STATS = Stats()
+_NOTHING = contextlib.nullcontext()
+
+
+def enable(stats=None):
+    ''' Start recording into stats, or a new Stats object, and return it '''
+    global ENABLED, STATS
+    STATS = Stats() if stats is None else stats
+    ENABLED = True
+    return STATS
+
+
+def disable():
+    ''' Stop recording, and return what was recorded '''
+    global ENABLED
+    ENABLED = False
+    return STATS
+
+
+@contextlib.contextmanager
+def collect(stats=None):
+    ''' Record into stats, or a new Stats object, within a with block,
+    then restore whatever was being recorded before '''
+    previous = ENABLED, STATS
+    try:
+        yield enable(stats)
+    finally:
+        _restore(*previous)
+
+
+def _restore(enabled, stats):
+    global ENABLED, STATS
+    ENABLED, STATS = enabled, stats
+
+
+def count(name, n=1):
+    ''' Add n to the named counter, if enabled '''
+    if ENABLED:
+        STATS.count(name, n)
+
+
+class _Timer():
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STATS.add_time(self.name, time.perf_counter() - self.start)
+
+
+def timer(name):
+    ''' Return a context manager adding the time spent within it to the
+    named timer, if enabled '''
+    return _Timer(name) if ENABLED else _NOTHING
+
+
+def timed(name):
+    ''' Decorate a function to add each call's duration to the named timer,
+    if enabled '''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                STATS.add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
@@ -0,0 +1,188 @@
+'''
+This file concerns the import of musical information from Standard MIDI
+Files, streaming their events to avoid holding large files in memory.
+'''
+
+import heapq
+import struct
+import time
+import music
+
+BLOCK = 2**16  # Bytes read from disk at a time, per track
+MIDDLE_C = 60  # MIDI note number of C4, music value 0
+DRUMS = 9  # General MIDI percussion channel, which has no pitches
+
+
+class MidiFile():
+    ''' Reads the header of a MIDI file, then streams its tracks on demand.
+    Simultaneous note-ons are grouped into chords, with onsets quantized to
+    multiples of a fraction of a whole note, and each chord lasting until
+    the next one begins. Tempo, velocity and rests are ignored. '''
+    def __init__(self, path, quantize=1/32, channels=None):
+        ''' channels is a collection of channel numbers (0-15) to include,
+        by default all except General MIDI percussion '''
+        self.path = path
+        self.quantize = quantize
+        if channels is None:
+            channels = set(range(16)) - {DRUMS}
+        self.channels = set(channels)
+        self.events = 0  # Track events parsed so far
+        self.elapsed = 0  # Seconds spent parsing
+
+        with open(path, 'rb') as f:
+            chunk, length = struct.unpack('>4sI', f.read(8))
+            if chunk != b'MThd' or length < 6:
+                raise ValueError(f'{path} is not a MIDI file')
+            self.format, ntracks, self.division = struct.unpack('>HHH', f.read(6))
+            if self.division & 0x8000:
+                raise ValueError('SMPTE time division is not supported')
+            # Locate each track chunk, skipping over unknown chunk types
+            self.tracks = []
+            f.seek(8 + length)
+            while len(self.tracks) < ntracks:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk, length = struct.unpack('>4sI', header)
+                if chunk == b'MTrk':
+                    self.tracks.append((f.tell(), length))
+                f.seek(length, 1)
+
+    def __repr__(self):
+        return f"MidiFile('{self.path}')"
+
+    @property
+    def rate(self):
+        ''' Events parsed per second '''
+        try: return self.events / self.elapsed
+        except ZeroDivisionError: return 0
+
+    def notes(self):
+        ''' Yield (tick, pitch value, on) for every note event of the
+        selected channels, in time order across all tracks '''
+        tracks = [self.read_track(*track) for track in self.tracks]
+        yield from heapq.merge(*tracks, key=lambda event: event[0])
+
+    def chords(self):
+        ''' Yield a (tuple of pitch values, duration) pair for each chord '''
+        start = time.perf_counter()
+        grid = 4 * self.division * self.quantize  # Ticks per quantum
+        onset, pitches = None, set()
+        end = None  # Last note-off of the current chord
+        try:
+            for tick, value, on in self.notes():
+                if not on:
+                    if value in pitches:
+                        end = max(end, tick)
+                    continue
+                step = round(tick / grid)
+                if step != onset:
+                    if pitches:
+                        yield (tuple(sorted(pitches)),
+                               (step - onset) * self.quantize)
+                    onset, pitches, end = step, set(), tick
+                pitches.add(value)
+            if pitches:
+                # The final chord lasts as long as its notes are held
+                steps = max(1, round(end / grid) - onset)
+                yield tuple(sorted(pitches)), steps * self.quantize
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def song(self):
+        ''' Return a Song of every chord in the file, built in bulk '''
+        values, durations = [], []
+        for chord, duration in self.chords():
+            values.append(chord)
+            durations.append(duration)
+        return music.Song.from_values(values, durations)
+
+    def read_track(self, offset, length):
+        ''' Yield (tick, pitch value, on) for the notes of one track chunk,
+        reading BLOCK bytes at a time from its own file handle '''
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            stream = _Stream(f, length)
+            tick = 0
+            status = None  # For running status
+            try:
+                while True:
+                    tick += stream.varlen()
+                    byte = stream.byte()
+                    self.events += 1
+                    if byte == 0xFF:  # Meta event
+                        kind = stream.byte()
+                        stream.skip(stream.varlen())
+                        status = None
+                        if kind == 0x2F:  # End of track
+                            return
+                        continue
+                    elif byte in (0xF0, 0xF7):  # System exclusive
+                        stream.skip(stream.varlen())
+                        status = None
+                        continue
+                    elif byte & 0x80:
+                        status = byte
+                        first = stream.byte()
+                    elif status is None:
+                        raise ValueError(f'Corrupt track data in {self.path}')
+                    else:
+                        first = byte  # Running status reuses the last one
+                    kind, channel = status & 0xF0, status & 0x0F
+                    second = stream.byte() if kind not in (0xC0, 0xD0) else 0
+                    if kind in (0x80, 0x90) and channel in self.channels:
+                        on = kind == 0x90 and second > 0  # Velocity 0 is off
+                        yield tick, first - MIDDLE_C, on
+            except EOFError:
+                return  # Tolerate missing end of track events
+
+
+class _Stream():
+    ''' Buffered byte access to at most length bytes of a file '''
+    def __init__(self, f, length):
+        self.f = f
+        self.left = length
+        self.buffer = b''
+        self.pos = 0
+
+    def byte(self):
+        if self.pos >= len(self.buffer):
+            self.fill()
+        self.pos += 1
+        return self.buffer[self.pos - 1]
+
+    def skip(self, n):
+        while n > len(self.buffer) - self.pos:
+            n -= len(self.buffer) - self.pos
+            self.fill()
+        self.pos += n
+
+    def varlen(self):
+        ''' Read a variable length quantity, 7 bits per byte '''
+        value = 0
+        while True:
+            byte = self.byte()
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+
+    def fill(self):
+        self.buffer = self.f.read(min(BLOCK, self.left))
+        self.left -= len(self.buffer)
+        self.pos = 0
+        if not self.buffer:
+            raise EOFError
+
+
+def read_song(path, quantize=1/32, channels=None):
+    ''' Return a Song of the notes in a MIDI file '''
+    return MidiFile(path, quantize, channels).song()
+
+
+if __name__ == '__main__':
+    import sys
+    for path in sys.argv[1:]:
+        midi = MidiFile(path)
+        song = midi.song()
+        print(f'{path}: {len(song)} chords, {midi.events} events '
+              f'in {midi.elapsed:.2f}s ({midi.rate:.0f} events/s)')
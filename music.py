@@ -3,7 +3,11 @@ This file concerns musical information in an abstract sense, as well as the
 relationships between individual notes and the layout of a standard guitar.
 '''
 
+import bisect
+import functools
 import itertools as it
+import numpy as np
+import instrument
 from tab import Shape
 
 LOW_E = -8
@@ -19,6 +23,8 @@ for l, v in zip(LETTERS, VALUES):
     NAME[v] = l
 ACCIDENTAL = {'b': -1, '#': 1}
 
+VALUE_DTYPE = np.int16  # Storage type of pitch values in Song arrays
+
 MAX_FRET = 18
 MAX_SPAN = 5
 
@@ -27,6 +33,8 @@ class Pitch():
     ''' A Pitch represents a particular musical tone. It contains
     information about their relationships to one another, as well as
     naming conventions and potential fretboard locations. '''
+    __slots__ = ('name', 'value', 'shapes')
+
     def __init__(self, pitch):
         ''' Accepts string format: {letter}{#/b}{octave}, e.g. C4, E#2, Ab4
         and numerical format: middle C/C4 = 0, +/- 1 per half-step '''
@@ -107,19 +115,15 @@ class Pitch():
             return None
         return value
 
-    def get_shapes(self, tuning=STD_TUNING):
+    def get_shapes(self, tuning=STD_TUNING, capo=0):
         ''' Return a list of potential Shape objects for this Pitch '''
-        shapes = []
-        for string, value in enumerate(tuning):
-            if self.value >= LOW_E + value:
-                fret = self.value - LOW_E - value
-                if fret <= MAX_FRET:  # Don't pass the end of the fretboard
-                    shapes.append(Shape((string, fret)))
-        return shapes
+        return locate(self.value, tuning, capo)
 
 
 class Note(Pitch):
     ''' A Note is a Pitch plus an appropriate time duration value '''
+    __slots__ = ('duration',)
+
     def __init__(self, pitch, duration=1/4):
         ''' Accepts one Pitch value parameter, and one optional duration '''
         super().__init__(pitch)
@@ -135,11 +139,13 @@ class Note(Pitch):
 class Chord():
     ''' A Chord is a set of concurrent Notes. Its duration is equal to that
     of its shortest note, since tab sacrifices timing info for readability '''
+    __slots__ = ('notes', 'shapes', 'duration')
+
+    @instrument.timed('music.Chord')
     def __init__(self, note_list, duration=1/4):
         ''' note_list is a list of Note objects or Note constructor arguments,
         with duration applied to each constructed Note'''
         self.notes = []
-        self.shapes = []
 
         # Add notes to list, constructing them first if needed
         for note in set(note_list):
@@ -153,13 +159,7 @@ class Chord():
         self.duration = min(note.duration for note in self.notes)
 
         # Generate all possible fingering combinations
-        for shapes in it.product(*[note.shapes for note in self.notes]):
-            shape = Shape()
-            for i in shapes:
-                shape += i
-            # Shape must hit every note, and not stretch too far
-            if len(shape) == len(self.notes) and shape.span <= MAX_SPAN:
-                self.shapes.append(shape)
+        self.shapes = self.get_shapes()
 
     def __repr__(self):
         return str([note.name for note in sorted(self.notes)])
@@ -170,41 +170,307 @@ class Chord():
     def __hash__(self):
         return tuple(self.notes)
 
-    @ property
+    @property
     def shape(self):
         ''' Minimizes Hand.strain to return the easiest shape of this chord'''
-        from player import Hand  # Circular dependency
-        best = None
-        for shape in self.shapes:
-            h = Hand(shape)
-            try:
-                if h.strain < best.strain:
-                    best = h
-            except AttributeError: best = h
-        return best.shape
+        return self.get_shape()
+
+    def get_shapes(self, tuning=STD_TUNING, capo=0, position=None):
+        ''' Return a list of every playable Shape of this chord, in the given
+        tuning, with fret numbers relative to the capo. position may be a
+        (low, high) fret range, to only return shapes fretted within it,
+        unless there are none, in which case all shapes are returned. '''
+        values = tuple(note.value for note in self.notes)
+        if position is not None:
+            shapes = get_voicing_index(values, tuple(tuning), capo).query(*position)
+            if shapes:
+                return shapes
+        return list(get_voicings(values, tuple(tuning), capo))
+
+    def get_shape(self, tuning=STD_TUNING, capo=0, position=None):
+        ''' Minimizes Hand.strain to return the easiest shape of this chord,
+        in the given tuning, with fret numbers relative to the capo '''
+        from player import Hand, strain_of  # Circular dependency
+        best, least = None, None
+        for shape in self.get_shapes(tuning, capo, position):
+            strain = strain_of(shape)
+            if best is None or strain < least:
+                best, least = shape, strain
+        if best is None:
+            raise ValueError(f'{self} cannot be played')
+        return Hand(best).shape
+
+
+class VoicingIndex():
+    ''' Indexes the shapes of a chord by the range of frets they cover and
+    the strings they use, to quickly find those within a hand position.
+    Shapes are kept sorted by their lowest fretted note, with all-open
+    shapes, which fit any position, first. '''
+    __slots__ = ('shapes', 'lows', 'highs', 'masks', 'order', 'open')
+
+    def __init__(self, shapes):
+        entries = []
+        for i, shape in enumerate(shapes):
+            fretted = [f for f in shape.list_frets() if f]
+            mask = sum(1 << s for s, _ in shape.list_tuples())
+            entries.append((min(fretted, default=0), max(fretted, default=0),
+                            mask, i, shape))
+        entries.sort(key=lambda entry: (entry[0], entry[3]))
+        self.lows, self.highs, self.masks, self.order, self.shapes = (
+            [list(column) for column in zip(*entries)] or [[]] * 5)
+        self.open = bisect.bisect_right(self.lows, 0)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def query(self, low=1, high=MAX_FRET, strings=None):
+        ''' Return every shape whose fretted notes all lie within frets low
+        to high, optionally using only the given collection of strings,
+        in their original order '''
+        mask = None if strings is None else sum(1 << s for s in strings)
+        start = max(self.open, bisect.bisect_left(self.lows, low))
+        stop = bisect.bisect_right(self.lows, high)
+        found = []
+        for i in it.chain(range(self.open), range(start, stop)):
+            if self.highs[i] <= high and (mask is None or not self.masks[i] & ~mask):
+                found.append((self.order[i], self.shapes[i]))
+        return [shape for _, shape in sorted(found, key=lambda x: x[0])]
 
 
 class Song():
     ''' A Song is an ordered list of Note/Chord objects with their
-    respective durations, played in order to produce music '''
+    respective durations, played in order to produce music.
+
+    Pitches are also stored in flat parallel arrays: chord i consists of
+    values[offsets[i]:offsets[i+1]] and lasts durations[i]. Chord objects
+    are only built when notes are requested, so songs loaded in bulk via
+    from_values/from_arrays stay cheap. The arrays are never modified in
+    place, so transposed or sliced songs may safely share them. '''
     def __init__(self, notes=None):
-        self.notes = []
+        self._values = np.empty(0, dtype=VALUE_DTYPE)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._durations = np.empty(0, dtype=np.float64)
+        self._chords = []  # Chord objects, or None if not yet constructed
+        self._complete = True  # No None placeholders in self._chords
         if notes is not None:
             for note in notes:
                 self.add(note)
 
     def __len__(self):
-        return len(self.notes)
+        return len(self._chords)
+
+    def __iter__(self):
+        return iter(self.notes)
+
+    def __getitem__(self, key):
+        ''' Integers return a single Chord, slices return a new Song '''
+        if isinstance(key, slice):
+            return self.take(range(len(self))[key])
+        return self.get_chord(range(len(self))[key])
+
+    def __reduce__(self):
+        ''' Pickle only the arrays, e.g. when sending songs to processes '''
+        return (self.from_arrays, (self.values, self.offsets, self.durations))
+
+    @classmethod
+    def from_arrays(cls, values, offsets, durations):
+        ''' Construct a Song directly from its columnar representation,
+        without building any Note or Chord objects '''
+        values = np.asarray(values, dtype=VALUE_DTYPE)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        durations = np.asarray(durations, dtype=np.float64)
+        if durations.ndim == 0:
+            durations = np.full(len(offsets) - 1, durations)
+        if (offsets.ndim != 1 or len(offsets) != len(durations) + 1
+                or offsets[0] != 0 or offsets[-1] != len(values)):
+            raise ValueError('Inconsistent Song array lengths')
+        song = cls()
+        song._values, song._offsets, song._durations = values, offsets, durations
+        song._chords = [None] * len(durations)
+        song._complete = not song._chords
+        return song
+
+    @classmethod
+    def from_values(cls, values, durations=1/4):
+        ''' values is a sequence of integer pitch values, one per note, or
+        of sequences of them, one per chord. durations is either a single
+        float for every chord, or a sequence with one float per chord. '''
+        try:
+            flat = np.asarray(values, dtype=VALUE_DTYPE)
+        except (TypeError, ValueError):
+            flat = None  # Ragged chords
+        if flat is not None and flat.ndim == 1:
+            offsets = np.arange(len(flat) + 1)
+        else:
+            chords = []
+            for chord in values:
+                try: chords.append(sorted(set(chord)))
+                except TypeError: chords.append([chord])  # Single note
+            offsets = np.zeros(len(chords) + 1, dtype=np.int64)
+            np.cumsum([len(chord) for chord in chords], out=offsets[1:])
+            flat = np.fromiter(it.chain.from_iterable(chords),
+                               dtype=VALUE_DTYPE, count=offsets[-1])
+        return cls.from_arrays(flat, offsets, durations)
+
+    @property
+    def notes(self):
+        ''' The list of Chord objects, constructed on first access '''
+        if not self._complete:
+            for i, chord in enumerate(self._chords):
+                if chord is None:
+                    self._chords[i] = self.get_chord(i)
+            self._complete = True
+        return self._chords
+
+    @property
+    def values(self):
+        self._flush()
+        return self._values
+
+    @property
+    def offsets(self):
+        self._flush()
+        return self._offsets
+
+    @property
+    def durations(self):
+        self._flush()
+        return self._durations
 
     def add(self, obj):
         if isinstance(obj, Note):
-            self.notes.append(Chord([obj]))
+            self._chords.append(Chord([obj]))
         elif isinstance(obj, Chord):
-            self.notes.append(obj)
+            self._chords.append(obj)
         else:
-            try: self.notes.append(Chord([Note(obj)]))
+            try: self._chords.append(Chord([Note(obj)]))
             except (TypeError, AttributeError): pass
 
+    def pitches(self):
+        ''' Return a list with a tuple of pitch values for each chord '''
+        values = self.values.tolist()
+        offsets = self.offsets.tolist()
+        return [tuple(values[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def repeats(self, length=4):
+        ''' Find every passage of length chords which occurs more than once.
+        Returns a dict of {passage: [start indices]}, where each passage is
+        a tuple of the pitch tuples of its chords, as from pitches() '''
+        pitches = self.pitches()
+        starts = {}
+        for i in range(len(pitches) - length + 1):
+            starts.setdefault(tuple(pitches[i:i+length]), []).append(i)
+        return {k: v for k, v in starts.items() if len(v) > 1}
+
+    def get_chord(self, i):
+        ''' Return the Chord at index i, constructing it if necessary '''
+        chord = self._chords[i]
+        if chord is None:
+            start, stop = self._offsets[i], self._offsets[i+1]
+            chord = make_chord(tuple(self._values[start:stop].tolist()),
+                               float(self._durations[i]))
+        return chord
+
+    def take(self, indices):
+        ''' Return a new Song made of the chords at the given indices '''
+        self._flush()
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) and np.all(np.diff(indices) == 1):
+            # Contiguous ranges can share memory with this Song
+            start, stop = indices[0], indices[-1] + 1
+            song = self.from_arrays(
+                self._values[self._offsets[start]:self._offsets[stop]],
+                self._offsets[start:stop+1] - self._offsets[start],
+                self._durations[start:stop])
+        else:
+            lengths = np.diff(self._offsets)[indices]
+            offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            starts = np.repeat(self._offsets[indices] - offsets[:-1], lengths)
+            song = self.from_arrays(
+                self._values[starts + np.arange(offsets[-1])],
+                offsets, self._durations[indices])
+        song._chords = [self._chords[i] for i in indices.tolist()]
+        song._complete = all(c is not None for c in song._chords)
+        return song
+
+    def transpose(self, interval):
+        ''' Return a new Song shifted by interval semitones '''
+        self._flush()
+        return self.from_arrays(self._values + interval, self._offsets,
+                                self._durations)
+
+    def _flush(self):
+        ''' Append any individually added chords to the arrays '''
+        added = self._chords[len(self._durations):]
+        if not added:
+            return
+        lengths = [len(chord.notes) for chord in added]
+        values = [note.value for chord in added for note in chord.notes]
+        offsets = np.cumsum(lengths) + self._offsets[-1]
+        self._values = np.concatenate(
+            (self._values, np.array(values, dtype=VALUE_DTYPE)))
+        self._offsets = np.concatenate((self._offsets, offsets))
+        self._durations = np.concatenate(
+            (self._durations, [chord.duration for chord in added]))
+
+
+def diatonic_values(steps):
+    ''' Return an array of the values of the natural notes the given
+    array of diatonic steps above middle C, e.g. 1 for D4, -1 for B3 '''
+    steps = np.asarray(steps, dtype=np.int64)
+    return MIDDLE_C + 12 * (steps // 7) + np.take(VALUES, steps % 7)
+
+
+@functools.lru_cache(maxsize=4096)
+def make_chord(values, duration=1/4):
+    ''' Return a Chord of the given tuple of integer pitch values. Repeated
+    chords share a single object, so their shapes are only computed once. '''
+    return Chord(list(values), duration)
+
+
+@functools.lru_cache(maxsize=65536)
+def get_voicing_index(values, tuning=tuple(STD_TUNING), capo=0):
+    ''' Return a shared VoicingIndex of get_voicings(values, tuning, capo) '''
+    return VoicingIndex(get_voicings(values, tuning, capo))
+
+
+def locate(value, tuning=STD_TUNING, capo=0):
+    ''' Return a list of Shapes for each string able to play pitch value.
+    With a capo, frets are relative to it, and must not fall behind it. '''
+    shapes = []
+    for string, open_value in enumerate(tuning):
+        fret = value - LOW_E - open_value - capo
+        if 0 <= fret <= MAX_FRET - capo:  # Don't pass the end of the fretboard
+            shapes.append(Shape((string, fret)))
+    return shapes
+
+
+@functools.lru_cache(maxsize=65536)
+def get_voicings(values, tuning=tuple(STD_TUNING), capo=0):
+    ''' Return a tuple of every Shape playing all of the given sorted tuple
+    of pitch values at once. Shared by every Chord and Guitarist, so each
+    distinct chord is only voiced once per tuning. A capo lowers every fret
+    alike, so its voicings are those of the chord transposed down by capo
+    without one, short of the end of the fretboard, and trying each capo
+    position reuses any voicings already found. '''
+    if capo:
+        highest = MAX_FRET - capo
+        return tuple(shape for shape in
+                     get_voicings(tuple(v - capo for v in values), tuning)
+                     if max(f for f in shape.list_frets() if f is not None)
+                     <= highest)
+    voicings = []
+    for shapes in it.product(*[locate(v, tuning, capo) for v in values]):
+        shape = Shape()
+        for i in shapes:
+            shape += i
+        # Shape must hit every note, and not stretch too far
+        if len(shape) == len(values) and shape.span <= MAX_SPAN:
+            voicings.append(shape)
+    instrument.count('music.shapes', len(voicings))
+    return tuple(voicings)
+
 
 if __name__ == '__main__':
 
@@ -3,8 +3,25 @@ This file concerns the selection of concrete, playable fretboard patterns from
 abstract collections of musical notes.
 '''
 
+import functools
+import heapq
 import itertools as it
-import tab, music
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import instrument, tab, music, storage
+
+try:
+    import numba
+except ImportError:  # Optional, to compile score_steps()
+    numba = None
+
+FRET_BIAS = 32  # Added to frets in packed Hand states, to keep them positive
+MAX_STEPS = 2**14  # Remembered Hand moves per Guitarist, before forgetting old ones
+TABLE = os.path.join('.cache', 'steps.bin')  # Made by build_table()
+TABLE_MAGIC = b'TABSTEP\0'
+NO_FRET = -1000  # Unplayed strings in the step kernels
 
 
 class Hand():
@@ -13,11 +30,13 @@ class Hand():
     - No finger may occupy a lower fret than any lower-numbered finger.
     - Fingers may share a fret, if the higher finger is on a higher string.
     - Finger 0 may barre all strings above its target at the same fret. '''
+    __slots__ = ('capo', 'barre', 'open_strings', 'fingers')
+
     def __init__(self, initial=None):
         self.capo = 0
         self.barre = False
         self.open_strings = []
-        self.fingers = [Finger() for i in range(4)]
+        self.fingers = (Finger(), Finger(), Finger(), Finger())
         if initial:
             self.move(initial)
 
@@ -29,17 +48,61 @@ class Hand():
     def shape(self):
         ''' Outputs a tab-compatible list of tuples: [(string, fret)]
         describing the locations of its Fingers in a given fingering shape'''
-        shape = [(s, 0) for s in self.open_strings]  # Add open notes right away
+        return music.Shape(self.frets())
+
+    @property
+    def state(self):
+        ''' Packs the position of this Hand into a single integer, which is
+        cheap to copy, hash and compare, and may be passed to restore().
+        Bits 0-5 mark open strings, bit 6 the barre, and each finger then
+        uses 10 bits: 1 if down, 3 for its string, and 6 for its fret. '''
+        state = self.barre << 6
+        for s in self.open_strings:
+            state |= 1 << s
+        for i, f in enumerate(self.fingers):
+            if f.down:
+                string, fret = f.position
+                fret += FRET_BIAS
+                if not 0 <= fret < 64:
+                    raise ValueError(f'Fret {fret - FRET_BIAS} cannot be packed')
+                state |= (1 | string << 1 | fret << 4) << (7 + 10*i)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        ''' Construct a new Hand in the position packed into state '''
+        hand = cls()
+        hand.restore(state)
+        return hand
+
+    def restore(self, state):
+        ''' Return to a position previously packed by Hand.state '''
+        self.barre = bool(state >> 6 & 1)
+        self.open_strings = [s for s in range(6) if state >> s & 1]
+        for i, f in enumerate(self.fingers):
+            bits = state >> (7 + 10*i)
+            if bits & 1:
+                f.down = True
+                f.position = (bits >> 1 & 7, (bits >> 4 & 63) - FRET_BIAS)
+            else:
+                f.lift()
+
+    def frets(self):
+        ''' Return a fret-list of every string this Hand is playing, with
+        any barre covering the higher strings not held by other fingers '''
+        frets = [None] * 6
+        for s in self.open_strings:
+            frets[s] = 0  # Add open notes right away
         for f in self.fingers:
             if f.down:
-                shape.append((f.string, f.fret))
+                frets[f.position[0]] = f.position[1]
         # Add each higher string at index finger's fret
         if self.barre:
+            index = self.index
             for string in range(self.fingers[0].string + 1, 6):
-                # Don't add string being played by other fingers
-                if string not in [pos[0] for pos in shape]:
-                    shape.append((string, self.index))
-        return music.Shape(shape)
+                if frets[string] is None:
+                    frets[string] = index
+        return frets
 
     @property
     def strain(self):
@@ -51,71 +114,66 @@ class Hand():
         Frets above 12 add 1 extra strain per fret per finger '''
         strain = 0
         # Shape strain
-        for a, b in zip(self.fingers[:-1], self.fingers[1:]):
-            try:
-                strain += abs(b.fret - (a.fret+1))
-                strain += max((abs(b.string - a.string) - 1), 0)
-            except TypeError: continue
+        a = None
+        for b in self.fingers:
+            if a is not None and a.down and b.down:
+                strain += abs(b.position[1] - (a.position[1]+1))
+                strain += max((abs(b.position[0] - a.position[0]) - 1), 0)
+            a = b
         # Barre strain
-        tuples = self.shape.list_tuples()
         if self.barre:
-            strain += len([n for n in tuples if n[1] == self.index]) - 1
+            strain += self.frets().count(self.index) - 1
         # High note strain
         for f in self.fingers:
-            if f.down and f.fret > 12:
-                strain += f.fret - 12
+            if f.down and f.position[1] > 12:
+                strain += f.position[1] - 12
         return strain
 
     def move(self, shape):
         ''' Move to a new position represented by a Shape object, shape
         Return an integer representing the difficulty of the transition'''
+        instrument.count('player.Hand.move')
         difficulty = 0
         if isinstance(shape, music.Shape):
-            new = set(shape.list_tuples())
+            new = shape.list_tuples()
         else:
             new = set(shape)
-        done = set()
 
         # Open strings are free
         self.open_strings = [note[0] for note in new if note[1] == 0]
-        [done.add((i, 0)) for i in self.open_strings]
-        if done == new: return difficulty
+        todo = {note for note in new if note[1] != 0}
+        if not todo: return difficulty
 
         # Place the index (i) finger (and slide whole hand with it)
-        i_fret = min(note[1] for note in new if note[1] > 0)
-        i_pos = sorted(note for note in new if note[1] == i_fret)[0]
+        i_fret, i_string = min((n[1], n[0]) for n in todo if n[1] > 0)
+        i_pos = (i_string, i_fret)
         try: slide = i_fret - self.index
         except TypeError: slide = i_fret  # This is probably wrong
         difficulty += self.fingers[0].move(i_pos)
-        done.add(i_pos)
+        todo.discard(i_pos)
 
         # Other fingers get free movement for the initial slide.
         for f in self.fingers[1:]:
-            try: f.move((f.string, f.fret + slide))
-            except TypeError: continue
+            if f.down:
+                f.move((f.position[0], f.position[1] + slide))
 
         # Barre the index finger if necessary/possible
-        barred = [note for note in new-done if note[1] == i_fret]
+        barred = {note for note in todo if note[1] == i_fret}
         # Don't barre if open notes are needed above index finger
-        blocked = [n for n in done if n[1] < i_fret and n[0] > i_pos[0]]
+        blocked = any(s > i_string for s in self.open_strings)
         if barred and not blocked:
             self.barre = True
-            [done.add(note) for note in barred]
-
-        # Place the other fingers, at cost
-        def place_finger(finger, prev_fret):
-            nonlocal difficulty
-            try:
-                fret = min(note[1] for note in new-done if note[1] >= prev_fret)
-                pos = sorted(note for note in new-done if note[1] == fret)[0]
-                difficulty += finger.move(pos)
-                done.add(pos)
-            except (ValueError, IndexError): return prev_fret
-            return fret
+            todo -= barred
 
+        # Place the other fingers, at cost, each on the lowest remaining
+        # fret no lower than the previous finger, then the lowest string
         prev_fret = i_fret
         for f in self.fingers[1:]:
-            prev_fret = place_finger(f, prev_fret)
+            try: fret, string = min((n[1], n[0]) for n in todo if n[1] >= prev_fret)
+            except ValueError: continue
+            difficulty += f.move((string, fret))
+            todo.discard((string, fret))
+            prev_fret = fret
 
         return difficulty
 
@@ -123,6 +181,8 @@ class Hand():
 class Finger():
     ''' A Finger is controlled by a Hand, but handles simpler fretboard
     maneuvers on its own, calculating relative difficulty of movement '''
+    __slots__ = ('position', 'down')
+
     def __init__(self, string=None, fret=None):
         if string in range(6) and type(fret) is int and fret > 0:
             self.position = (string, fret)
@@ -154,7 +214,8 @@ class Finger():
             self.position = new
             return 0
         else:  # Moving placed fingers is hard
-            difficulty = sum(abs(a - b) for a, b in zip(new, self.position))
+            difficulty = (abs(new[0] - self.position[0])
+                          + abs(new[1] - self.position[1]))
             self.position = new
             return difficulty
 
@@ -162,63 +223,736 @@ class Finger():
 class Guitarist():
     ''' The Guitarist is responsible for reading a Song, and producing
     an Arrangement by guiding a Hand along the easiest route through
-    the possible shapes of the musical objects it contains. '''
-    def __init__(self, song=None):
+    the possible shapes of the musical objects it contains. Frets are
+    numbered relative to the capo, if one is used. '''
+    def __init__(self, song=None, tuning=music.STD_TUNING, capo=0,
+                 processes=1, engine='product', position=None):
+        ''' engine selects the search used by play(), one of ENGINES.
+        position may be a (low, high) range of frets to stay within, e.g.
+        (1, 4) for first position, wherever each chord allows it. '''
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine: {engine}')
+        self.tuning = tuple(tuning)
+        self.capo = capo
+        self.engine = engine
+        self.position = position and tuple(position)
+        self.expanded = 0  # Search nodes whose successors were explored
+        self.score = None
         self.arr = tab.Arrangement()
+        # Results of play() for passages already seen, by pitch sequence
+        self.memo = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.paths_skipped = 0  # Paths not re-scored thanks to the memo
+        # Results of Hand moves, by packed state and destination shape
+        self.steps = {}
+        self.hand = Hand()  # Reused for each new step
         if song:
             self.song = song
-            self.path = self.read(song)
+            self.path = self.read(song, processes=processes)
+            self.score = self.evaluate(self.path)
             try:
-                durations = (n.duration for n in self.song.notes)
+                durations = self.song.durations.tolist()
                 temp = [(a,b) for a,b in zip(self.path, durations)]
             except TypeError:
                 temp = None
             self.arr = tab.Arrangement(notes=temp)
 
-    def read(self, song, DELTA=3):
+    @property
+    def options(self):
+        ''' Keyword arguments to create a Guitarist which plays the same way '''
+        return {'tuning': self.tuning, 'capo': self.capo,
+                'engine': self.engine, 'position': self.position}
+
+    def voicings(self, chord):
+        ''' Return the list of possible shapes for chord in this tuning,
+        within this Guitarist's position, if possible '''
+        return chord.get_shapes(self.tuning, self.capo, self.position)
+
+    def playable(self, song):
+        ''' True if every chord in song has at least one possible shape '''
+        return all(self.voicings(chord) for chord in song.notes)
+
+    def evaluate(self, path):
+        ''' Return the total difficulty of playing a sequence of shapes,
+        as scored by play() '''
+        score = 0
+        h = Hand()
+        for shape in path:
+            score += h.move(shape)
+            score += h.strain
+        return score
+
+    @instrument.timed('player.Guitarist.read')
+    def read(self, song, DELTA=3, processes=1):
         ''' This gradually pieces a song together via play(),
-        to mitigate exponential complexity.'''
-        path = []
-        # Play first three notes, and select best starting shape
-        passage = music.Song(song.notes[:DELTA])
-        shape = self.play(passage)
-        path.append(shape[0])
-        # Repeat in three-note sections, building off previous results
-        for i in range(1, len(song)-DELTA):
-            passage = music.Song([path[-1], *song.notes[i:i+DELTA+1]])
-            shape = self.play(passage)
+        to mitigate exponential complexity. Each passage is played on its
+        own, so they may be spread across processes and stitched together.'''
+        # Play first three notes, then the rest in overlapping sections
+        passages = [(0, DELTA)]
+        passages += [(i, i+DELTA+1) for i in range(1, len(song)-DELTA)]
+        shapes = self.play_passages(song, passages, processes)
+        # Select best starting shape, then the best of each section
+        path = [shapes[0][0]]
+        for shape in shapes[1:]:
             try: path.append(shape[0])
             except TypeError: continue  # Ignore notes out of range
         # Add final notes
-        for i in shape[1:]:
+        for i in shapes[-1][1:]:
             path.append(i)
         return path
 
+    def play_passages(self, song, passages, processes=1):
+        ''' Return the result of play() for each (start, stop) slice of song.
+        Passages with the same pitches are only played once, and new ones
+        are spread across a pool of worker processes unless processes is 1'''
+        pitches = song.pitches()
+        keys = [tuple(pitches[start:stop]) for start, stop in passages]
+        todo = {}
+        for key, passage in zip(keys, passages):
+            if key in self.memo or key in todo:
+                self.memo_hits += 1
+                instrument.count('player.passage_hits')
+                self.paths_skipped += self.count_paths(song.notes[slice(*passage)])
+            else:
+                self.memo_misses += 1
+                instrument.count('player.passage_misses')
+                todo[key] = passage
+        passages = list(todo.values())
+        if processes == 1 or len(passages) < 2:
+            shapes = [self.play(music.Song(song.notes[start:stop]))
+                      for start, stop in passages]
+        else:
+            shapes = self._play_in_pool(song, passages, processes)
+        self.memo.update(zip(todo, shapes))
+        return [self.memo[key] for key in keys]
+
+    def _play_in_pool(self, song, passages, processes):
+        with ProcessPoolExecutor(processes) as pool:
+            # Send each worker a contiguous run of passages, with its notes
+            workers = processes or os.cpu_count() or 1
+            size = -(-len(passages) // (4 * workers))
+            jobs = []
+            for i in range(0, len(passages), size):
+                run = passages[i:i+size]
+                lo, hi = run[0][0], max(stop for _, stop in run)
+                run = [(start - lo, stop - lo) for start, stop in run]
+                jobs.append(pool.submit(_play_passages, song[lo:hi], run,
+                                        self.options))
+            return [shape for job in jobs for shape in job.result()]
+
+    def count_paths(self, chords):
+        ''' Return the number of paths play() would score for chords '''
+        count = 1
+        for chord in chords:
+            count *= len(self.voicings(chord))
+        return count
+
+    @instrument.timed('player.Guitarist.play')
     def play(self, song):
         ''' This is a shortest path algorithm, using possible shapes as
         path nodes, and a combination of Hand.strain and Hand.move
-        difficulty as its path lengths. '''
+        difficulty as its path lengths. Returns the first best path in the
+        order of it.product, whichever engine is used to find it. '''
         if len(song.notes) == 1:
-            return [song.notes[0].shape]
+            return [song.notes[0].get_shape(self.tuning, self.capo,
+                                            self.position)]
+        paths = [self.voicings(note) for note in song.notes]
+        if self.engine == 'astar':
+            return self.play_astar(paths)
+        if self.engine == 'dp':
+            return self.play_dp(paths)
+        return self.play_product(paths)
+
+    def play_product(self, paths):
+        ''' Score every path, in the order of it.product, but depth first,
+        so that each shared prefix is only played once, branching from its
+        packed Hand state. '''
         best_score = None
         best_path = None
-        paths = [note.shapes for note in song.notes]
-        for path in it.product(*paths):
-            score = 0
-            h = Hand()
-            for shape in path:
-                score += h.move(shape)
-                score += h.strain
-            try:
-                if score < best_score:
+        path = [None] * len(paths)
+
+        def search(depth, state, score):
+            nonlocal best_score, best_path
+            if depth == len(paths):
+                if best_score is None or score < best_score:
                     best_score = score
-                    best_path = path
-            except TypeError:
-                best_score = score
-                best_path = path
+                    best_path = tuple(path)
+                return
+            self.expanded += 1
+            for shape in paths[depth]:
+                cost, new_state = self.step(state, shape)
+                path[depth] = shape
+                search(depth + 1, new_state, score + cost)
+
+        search(0, Hand().state, 0)
         return best_path
 
+    def play_astar(self, paths):
+        ''' A* search through the layers of shapes, expanding the lowest
+        score plus estimated remaining difficulty first. The estimate is
+        the least strain_bound() of each remaining chord, assuming free
+        movement, which never overestimates. Ties go to the first path in
+        it.product order, which is also what play_product() returns. '''
+        bounds = [min((strain_bound(shape) for shape in shapes), default=0)
+                  for shapes in paths]
+        remaining = [sum(bounds[i:]) for i in range(len(paths) + 1)]
+        # Entries: (estimate, indices of shapes so far, score, Hand state)
+        heap = [(remaining[0], (), 0, Hand().state)]
+        closed = set()
+        while heap:
+            _, prefix, score, state = heapq.heappop(heap)
+            depth = len(prefix)
+            if depth == len(paths):
+                return tuple(shapes[i] for shapes, i in zip(paths, prefix))
+            # The first visit to any state at each depth is the best one
+            if (depth, state) in closed:
+                continue
+            closed.add((depth, state))
+            self.expanded += 1
+            for i, shape in enumerate(paths[depth]):
+                cost, new_state = self.step(state, shape)
+                if (depth + 1, new_state) not in closed:
+                    heapq.heappush(heap, (score + cost + remaining[depth+1],
+                                          prefix + (i,), score + cost, new_state))
+        return None
 
-if __name__ == '__main__':
+    def play_dp(self, paths, interval=None):
+        ''' Dynamic programming through the layers of shapes, keeping only
+        the best path to each distinct Hand state at each depth, so time
+        grows linearly with the number of layers. Each layer is relaxed at
+        once by relax(), which scores its moves with score_steps(), compiled
+        if numba is installed, then keeps the best with NumPy sorts. Rather
+        than backpointers for every layer, only the best scores of every
+        interval-th layer (by default the square root of their number) are
+        kept, and the layers between them are replayed during traceback,
+        bounding memory at the cost of playing each layer twice. Ties go to
+        the first path in it.product order, as from play_product(). '''
+        if not all(paths):
+            return None
+        if interval is None:
+            interval = math.isqrt(len(paths)) or 1
+        # Layers are arrays of Hand states, their best scores, and ranks
+        # ordering the best paths to each state as it.product reaches them
+        layer = (np.array([Hand().state]), np.zeros(1, np.int64),
+                 np.zeros(1, np.int64))
+        checkpoints = {0: layer}
+        for depth, shapes in enumerate(paths, 1):
+            layer = self._relax(layer, shapes)[:3]
+            if depth % interval == 0 and depth < len(paths):
+                checkpoints[depth] = layer
+        _, scores, ranks = layer
+        position = np.lexsort((ranks, scores))[0]
+
+        # Trace back through each segment between checkpoints, from the end
+        indices = [None] * len(paths)
+        stop = len(paths)
+        for start in sorted(checkpoints, reverse=True):
+            layer, backs = checkpoints[start], []
+            for depth in range(start, stop):
+                *layer, previous, shape = self._relax(layer, paths[depth])
+                backs.append((previous, shape))
+            for depth in reversed(range(start, stop)):
+                previous, shape = backs[depth - start]
+                position, indices[depth] = previous[position], shape[position]
+            stop = start
+        return tuple(shapes[i] for shapes, i in zip(paths, indices))
+
+    def _relax(self, layer, shapes):
+        self.expanded += len(layer[0])
+        instrument.count('player.kernel_steps', len(layer[0]) * len(shapes))
+        return relax(*layer, shape_frets(shapes))
+
+    def step(self, state, shape):
+        ''' Return (difficulty, new state) for a Hand in the packed state
+        moving to shape, where difficulty is that of the move plus the
+        strain of the new position. Up to MAX_STEPS recent results are
+        remembered, keyed by a single int packing state and frets. '''
+        frets = tuple(shape.list_frets())
+        key = state << 48 | fret_code(frets)
+        try:
+            return self.steps[key]
+        except KeyError:
+            pass
+        if len(self.steps) >= MAX_STEPS:
+            # Forget the older half, in insertion order
+            for old in list(it.islice(self.steps, MAX_STEPS // 2)):
+                del self.steps[old]
+        table = get_table()
+        found = table.lookup(state, frets) if table is not None else None
+        if found is not None:
+            instrument.count('player.table_hits')
+        else:
+            hand = self.hand
+            hand.restore(state)
+            cost = hand.move(shape)
+            cost += hand.strain
+            found = (cost, hand.state)
+        self.steps[key] = found
+        return found
+
+    def __getstate__(self):
+        ''' Don't send remembered results between processes '''
+        state = self.__dict__.copy()
+        state['memo'], state['steps'] = {}, {}
+        return state
+
+
+ENGINES = ('product', 'astar', 'dp')
+TUNINGS = (tuple(music.STD_TUNING), tuple(music.DROP_D_TUNING))
+
+
+def optimize(song, capos=range(8), tunings=TUNINGS, processes=None,
+             position=None):
+    ''' Arrange song with each combination of capo position and tuning,
+    spread across a pool of worker processes, or in this process if
+    processes is 1. Returns a list of Guitarists for every playable
+    option, sorted from easiest to hardest by total score. Each option is
+    a full arrangement, so this costs about len(capos) * len(tunings) of
+    them; only voicings are shared, between capo positions. '''
+    options = [(tuple(tuning), capo, position)
+               for tuning in tunings for capo in capos]
+    if processes == 1:
+        results = [_arrange(song, *option) for option in options]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            # Each worker keeps its own voicing caches between options,
+            # reused by the capo positions of a tuning it has already tried
+            results = list(pool.map(_arrange, it.repeat(song),
+                                    *zip(*options)))
+    results = [g for g in results if g is not None]
+    results.sort(key=lambda g: g.score)
+    return results
+
+
+def _arrange(song, tuning, capo, position=None):
+    ''' Return a Guitarist arranging song with tuning and capo,
+    or None if any of its notes cannot be played that way '''
+    g = Guitarist(tuning=tuning, capo=capo, position=position)
+    if not g.playable(song):
+        return None
+    return Guitarist(song, **g.options)
+
+
+class StepTable():
+    ''' A table of the strain of every shape of a few notes, and of the
+    results of moving a Hand between each nearby pair of them, as made by
+    build_table(). Frets are geometric, so one table suits every tuning.
+    Arrays are memory-mapped, so processes share a single copy. Only moves
+    from a Hand freshly placed on a shape are held, since other states
+    are too varied to enumerate, so lookups must reject the rest cheaply. '''
+    def __init__(self, path=TABLE):
+        self.path = path
+        arrays, header = storage.read(path, TABLE_MAGIC)
+        if ((header['max_fret'], header['max_span'], header['fret_bias'])
+                != (music.MAX_FRET, music.MAX_SPAN, FRET_BIAS)):
+            raise ValueError(f'{path} was built with different limits')
+        for name, array in arrays.items():
+            # Plain views of the mapping, since indexing a memmap is slow
+            setattr(self, name, np.asarray(array))
+        # Look up shapes by fret-list, the results of placing an empty Hand
+        # on each, and the moves from the state of a Hand placed there
+        self.index = {}
+        for i, row in enumerate(self.frets.tolist()):
+            self.index[tuple(None if f < 0 else f for f in row)] = i
+        self.placed = list(zip(self.strains.tolist(), self.states.tolist()))
+        # Each shape's moves go to a contiguous run of the shapes, which are
+        # sorted by lowest fret, so a move is found without searching
+        indptr = self.indptr.tolist()
+        firsts = self.dest[self.indptr[:-1]].tolist()
+        self.fresh = {}
+        for i, state in enumerate(self.states.tolist()):
+            self.fresh.setdefault(state, (indptr[i], indptr[i+1], firsts[i]))
 
-    pass
+    def __repr__(self):
+        return f"StepTable('{self.path}')"
+
+    def strain(self, frets):
+        ''' Return the strain of a Hand placed at the fret-list tuple frets,
+        or None if that shape isn't in the table '''
+        i = self.index.get(frets)
+        return None if i is None else self.placed[i][0]
+
+    def lookup(self, state, frets):
+        ''' Return (difficulty, new state) as from Guitarist.step, or None
+        if the move isn't in the table '''
+        j = self.index.get(frets)
+        if j is None:
+            return None
+        if state == 0:  # Placing an empty Hand is free, save for strain
+            return self.placed[j]
+        try:
+            start, stop, first = self.fresh[state]
+        except KeyError:  # Not a fresh placement, so not in the table
+            return None
+        k = start + j - first
+        if start <= k < stop:
+            return int(self.costs[k]), int(self.next_states[k])
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def fret_code(frets):
+    ''' Pack a fret-list tuple into an int of 8 bits per string, with 0 for
+    unplayed strings, as used to key remembered moves '''
+    code = 0
+    for fret in frets:
+        code = code << 8 | (0 if fret is None else fret + 1)
+    return code
+
+
+_tables = {}
+
+
+def get_table(path=TABLE):
+    ''' Return the StepTable at path, loading it on first use, or None if
+    it hasn't been built '''
+    try:
+        return _tables[path]
+    except KeyError:
+        pass
+    try:
+        _tables[path] = StepTable(path)
+    except (OSError, ValueError, KeyError):
+        _tables[path] = None
+    return _tables[path]
+
+
+@functools.lru_cache(maxsize=None)
+def _strain_bound(frets):
+    hand = Hand([t for t in enumerate(frets) if t[1] is not None])
+    bound = hand.strain
+    if hand.barre:
+        bound -= hand.frets().count(hand.index) - 1
+    return bound
+
+
+def strain_bound(shape):
+    ''' Return the least strain a Hand can have after moving to shape, from
+    any position. This is its strain when placed there from scratch, less
+    any barre strain, since leftover fingers may shorten a barre. '''
+    return _strain_bound(tuple(shape.list_frets()))
+
+
+def strain_of(shape):
+    ''' Return the strain of a Hand placed at shape, from the table if
+    possible '''
+    table = get_table()
+    strain = table.strain(tuple(shape.list_frets())) if table else None
+    if strain is None:
+        strain = Hand(shape).strain
+    return strain
+
+
+def score_steps_loop(states, frets):
+    ''' Return arrays of (difficulty, new state) as from Guitarist.step, for
+    a Hand in each of the packed states moving to the shape in the same row
+    of frets, an (N, 6) array with -1 for unplayed strings. New states are
+    -1 if a fret cannot be packed. This follows Hand.move and Hand.strain
+    one pair at a time, and is compiled by numba, if installed. '''
+    n = len(states)
+    costs = np.zeros(n, np.int64)
+    new_states = np.zeros(n, np.int64)
+    down = np.zeros(4, np.int64)
+    string = np.zeros(4, np.int64)
+    fret = np.zeros(4, np.int64)
+    held = np.zeros(6, np.int64)
+    for k in range(n):
+        state = states[k]
+        row = frets[k]
+        barre = state >> 6 & 1
+        for i in range(4):
+            bits = state >> (7 + 10*i)
+            down[i] = bits & 1
+            string[i] = bits >> 1 & 7
+            fret[i] = (bits >> 4 & 63) - FRET_BIAS
+        opens = 0
+        todo = 0  # Bit mask of strings still to be fretted
+        for s in range(6):
+            if row[s] == 0:
+                opens |= 1 << s
+            elif row[s] > 0:
+                todo |= 1 << s
+
+        cost = 0
+        if todo:
+            # Index finger to the lowest fret, then string, sliding the rest
+            i_string = -1
+            for s in range(6):
+                if todo >> s & 1 and (i_string < 0 or row[s] < row[i_string]):
+                    i_string = s
+            i_fret = row[i_string]
+            slide = i_fret
+            if down[0]:
+                slide -= fret[0]
+                cost += abs(i_string - string[0]) + abs(i_fret - fret[0])
+            down[0] = 1
+            string[0] = i_string
+            fret[0] = i_fret
+            todo &= ~(1 << i_string)
+            for i in range(1, 4):
+                if down[i]:
+                    fret[i] += slide
+                    if fret[i] == 0:
+                        down[i] = 0
+            # Barre the index finger unless open notes are needed above it
+            barred = 0
+            blocked = False
+            for s in range(6):
+                if todo >> s & 1 and row[s] == i_fret:
+                    barred |= 1 << s
+                if opens >> s & 1 and s > i_string:
+                    blocked = True
+            if barred and not blocked:
+                barre = 1
+                todo &= ~barred
+            # Other fingers to the lowest remaining fret, then string
+            prev = i_fret
+            for i in range(1, 4):
+                best = -1
+                for s in range(6):
+                    if (todo >> s & 1 and row[s] >= prev
+                            and (best < 0 or row[s] < row[best])):
+                        best = s
+                if best < 0:
+                    continue
+                if down[i]:
+                    cost += abs(best - string[i]) + abs(row[best] - fret[i])
+                down[i] = 1
+                string[i] = best
+                fret[i] = row[best]
+                todo &= ~(1 << best)
+                prev = row[best]
+
+        # Strain of the new position
+        for i in range(1, 4):
+            if down[i-1] and down[i]:
+                cost += abs(fret[i] - fret[i-1] - 1)
+                cost += max(abs(string[i] - string[i-1]) - 1, 0)
+        if barre:
+            for s in range(6):
+                held[s] = 0 if opens >> s & 1 else NO_FRET
+            for i in range(4):
+                if down[i]:
+                    held[string[i]] = fret[i]
+            count = 0
+            for s in range(6):
+                if s > string[0] and held[s] == NO_FRET:
+                    held[s] = fret[0]
+                if held[s] == fret[0]:
+                    count += 1
+            cost += count - 1
+        for i in range(4):
+            if down[i] and fret[i] > 12:
+                cost += fret[i] - 12
+
+        new_state = barre << 6 | opens
+        for i in range(4):
+            if down[i]:
+                if not 0 <= fret[i] + FRET_BIAS < 64:
+                    new_state = -1
+                    break
+                new_state |= ((1 | string[i] << 1 | (fret[i] + FRET_BIAS) << 4)
+                              << (7 + 10*i))
+        costs[k] = cost
+        new_states[k] = new_state
+    return costs, new_states
+
+
+def score_steps_numpy(states, frets):
+    ''' As score_steps_loop, but for every pair at once in NumPy '''
+    n = len(states)
+    rows = np.arange(n)
+    strings = np.arange(6)
+    shifts = 7 + 10 * np.arange(4)
+    bits = states[:, None] >> shifts
+    down = (bits & 1).astype(bool)
+    string = bits >> 1 & 7
+    fret = (bits >> 4 & 63) - FRET_BIAS
+    barre = (states >> 6 & 1).astype(bool)
+    opens = frets == 0
+    todo = frets > 0
+    moving = todo.any(axis=1)  # The Hand stays put for open shapes
+    never = np.iinfo(np.int64).max
+    lowest = np.where(todo, frets * 8 + strings, never)
+
+    # Index finger to the lowest fret, then string, sliding the rest
+    i_string = lowest.argmin(axis=1)
+    i_fret = frets[rows, i_string]
+    cost = np.where(down[:, 0], abs(i_string - string[:, 0])
+                    + abs(i_fret - fret[:, 0]), 0)
+    slide = i_fret - np.where(down[:, 0], fret[:, 0], 0)
+    new_fret = fret.copy()
+    new_fret[:, 1:] += np.where(down[:, 1:], slide[:, None], 0)
+    new_down = down.copy()
+    new_down[:, 1:] &= new_fret[:, 1:] != 0
+    new_down[:, 0] = True
+    new_string = string.copy()
+    new_string[:, 0] = i_string
+    new_fret[:, 0] = i_fret
+    todo[rows, i_string] = False
+    # Barre the index finger unless open notes are needed above it
+    barred = todo & (frets == i_fret[:, None])
+    blocked = (opens & (strings > i_string[:, None])).any(axis=1)
+    barring = barred.any(axis=1) & ~blocked
+    new_barre = barre | barring
+    todo &= ~(barred & barring[:, None])
+    # Other fingers to the lowest remaining fret, then string
+    prev = i_fret
+    for i in range(1, 4):
+        free = todo & (frets >= prev[:, None])
+        found = free.any(axis=1)
+        best = np.where(free, frets * 8 + strings, never).argmin(axis=1)
+        best_fret = frets[rows, best]
+        cost += np.where(found & new_down[:, i], abs(best - new_string[:, i])
+                         + abs(best_fret - new_fret[:, i]), 0)
+        new_down[:, i] |= found
+        new_string[:, i] = np.where(found, best, new_string[:, i])
+        new_fret[:, i] = np.where(found, best_fret, new_fret[:, i])
+        todo[rows, best] &= ~found
+        prev = np.where(found, best_fret, prev)
+
+    cost = np.where(moving, cost, 0)
+    down = np.where(moving[:, None], new_down, down)
+    string = np.where(moving[:, None], new_string, string)
+    fret = np.where(moving[:, None], new_fret, fret)
+    barre = np.where(moving, new_barre, barre)
+
+    # Strain of the new position
+    pairs = down[:, 1:] & down[:, :-1]
+    cost += np.where(pairs, abs(fret[:, 1:] - fret[:, :-1] - 1)
+                     + np.maximum(abs(string[:, 1:] - string[:, :-1]) - 1, 0),
+                     0).sum(axis=1)
+    held = np.where(opens, 0, NO_FRET)
+    for i in range(4):
+        held[rows, string[:, i]] = np.where(down[:, i], fret[:, i],
+                                            held[rows, string[:, i]])
+    index = fret[:, :1]
+    held = np.where((strings > string[:, :1]) & (held == NO_FRET), index, held)
+    cost += np.where(barre, (held == index).sum(axis=1) - 1, 0)
+    cost += np.where(down & (fret > 12), fret - 12, 0).sum(axis=1)
+
+    packed = fret + FRET_BIAS
+    valid = ~(down & ((packed < 0) | (packed >= 64))).any(axis=1)
+    fingers = np.where(down, (1 | string << 1 | packed << 4) << shifts, 0)
+    new_states = (barre.astype(np.int64) << 6 | (opens << strings).sum(axis=1)
+                  | np.bitwise_or.reduce(fingers, axis=1))
+    return cost, np.where(valid, new_states, -1)
+
+
+if numba is not None:
+    score_steps = numba.njit(cache=True)(score_steps_loop)
+else:
+    score_steps = score_steps_numpy
+
+
+def shape_frets(shapes):
+    ''' Return an (N, 6) array of the frets of shapes, -1 where unplayed '''
+    return np.array([[-1 if f is None else f for f in shape.list_frets()]
+                     for shape in shapes], np.int64).reshape(-1, 6)
+
+
+def relax(states, scores, ranks, frets):
+    ''' Play each shape in frets from every Hand state of a layer of
+    Guitarist.play_dp(), given as arrays of states, their best scores and
+    the ranks of their best paths. Returns the next layer's arrays, plus
+    the position in this layer and shape index of each new state's best
+    path, preferring the lowest score, then rank, then shape index. '''
+    count = len(frets)
+    pairs = np.repeat(np.arange(len(states)), count)
+    shape = np.tile(np.arange(count), len(states))
+    costs, new_states = score_steps(states[pairs], frets[shape])
+    if (new_states < 0).any():
+        raise ValueError('A fret cannot be packed')
+    totals = scores[pairs] + costs
+    prefix = ranks[pairs]
+    order = np.lexsort((shape, prefix, totals, new_states))
+    sorted_states = new_states[order]
+    first = np.ones(len(order), bool)
+    first[1:] = sorted_states[1:] != sorted_states[:-1]
+    best = order[first]
+    new_ranks = np.empty(len(best), np.int64)
+    new_ranks[np.lexsort((shape[best], prefix[best]))] = np.arange(len(best))
+    return (new_states[best], totals[best], new_ranks,
+            pairs[best], shape[best])
+
+
+def voicing_space(max_notes=2):
+    ''' Return the fret-list of every shape of up to max_notes notes within
+    MAX_FRET and MAX_SPAN, ordered by lowest fretted note (0 if all open) '''
+    shapes = []
+    for n in range(1, max_notes + 1):
+        for strings in it.combinations(range(6), n):
+            for frets in it.product(range(music.MAX_FRET + 1), repeat=n):
+                fretted = [f for f in frets if f > 0]
+                if fretted and max(fretted) - min(fretted) > music.MAX_SPAN:
+                    continue
+                shape = [None] * 6
+                for string, fret in zip(strings, frets):
+                    shape[string] = fret
+                shapes.append((min(fretted, default=0), shape))
+    shapes.sort(key=lambda x: x[0])
+    return [shape for _, shape in shapes]
+
+
+def build_table(path=TABLE, max_notes=2, distance=2):
+    ''' Save a StepTable of every shape of up to max_notes notes, with the
+    results of moving between each pair whose lowest frets are within
+    distance of one another, to path. Guitarist.step uses it if present,
+    and simulates any other moves as usual. '''
+    shapes = voicing_space(max_notes)
+    lowest = [min([f for f in shape if f], default=0) for shape in shapes]
+    hand = Hand()
+    strains, states = [], []
+    for shape in shapes:
+        hand.restore(0)
+        hand.move(music.Shape(shape))
+        strains.append(hand.strain)
+        states.append(hand.state)
+
+    # Shapes are sorted by lowest fret, so neighbours are contiguous
+    indptr, dest, costs, next_states = [0], [], [], []
+    lo = hi = 0
+    for i, low in enumerate(lowest):
+        while lowest[lo] < low - distance:
+            lo += 1
+        while hi < len(shapes) and lowest[hi] <= low + distance:
+            hi += 1
+        for j in range(lo, hi):
+            hand.restore(states[i])
+            cost = hand.move(music.Shape(shapes[j]))
+            costs.append(cost + hand.strain)
+            next_states.append(hand.state)
+            dest.append(j)
+        indptr.append(len(dest))
+
+    frets = [[-1 if f is None else f for f in shape] for shape in shapes]
+    storage.write(path, TABLE_MAGIC, {
+        'frets': np.array(frets, '<i1').reshape(-1, 6),
+        'strains': np.array(strains, '<i2'),
+        'states': np.array(states, '<i8'),
+        'indptr': np.array(indptr, '<i8'),
+        'dest': np.array(dest, '<i4'),
+        'costs': np.array(costs, '<i2'),
+        'next_states': np.array(next_states, '<i8')},
+        max_fret=music.MAX_FRET, max_span=music.MAX_SPAN, fret_bias=FRET_BIAS,
+        max_notes=max_notes, distance=distance)
+    _tables.pop(path, None)  # Reload on next use
+    return len(shapes), len(dest)
+
+
+def _play_passages(song, passages, options):
+    ''' Worker process entry point for Guitarist.play_passages '''
+    return Guitarist(**options).play_passages(song, passages)
+
+
+if __name__ == '__main__':
+    import sys, time
+    # Build the step table: python player.py [path] [max_notes] [distance]
+    path = sys.argv[1] if len(sys.argv) > 1 else TABLE
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    start = time.perf_counter()
+    shapes, pairs = build_table(path, *map(int, sys.argv[2:4]))
+    print(f'{path}: {shapes} shapes, {pairs} moves, '
+          f'{os.path.getsize(path) / 2**20:.1f} MB, '
+          f'built in {time.perf_counter() - start:.1f}s')
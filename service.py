@@ -0,0 +1,387 @@
+'''
+This file concerns a long-running local transcription service, so that
+each request avoids the startup cost of Python, NumPy and OpenCV, plus a
+client for putting it under sustained load.
+
+Requests are plain HTTP/1.1, over TCP or a Unix socket:
+    POST /image     An encoded image, e.g. a PNG scan of a page
+    POST /song      JSON, either {"notes": ["E3", ["G3", "B3"], ...]}
+                    or {"values": [[0, 4, 7], ...], "durations": 0.25}
+    GET  /metrics   JSON counts and latency percentiles
+Both POSTs respond with tab as text. CPU work runs in a pool of worker
+processes. At most `queue` requests wait for a worker; beyond that, new
+ones are refused with 503 until there is room, rather than piling up.
+
+Usage:
+    python service.py [port | socket path] [workers] [queue]
+    python service.py load [port | socket path] [requests] [concurrency] [image]
+'''
+
+import asyncio
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import detect, music, player
+
+PORT = 8765
+MAX_BODY = 32 * 2**20  # Bytes
+MAX_HEADERS = 100
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def transcribe_image(data):
+    ''' Return tab for the bytes of an encoded image of sheet music '''
+    page = detect.decode_page(data)
+    return arrange(detect.StaffDetector('<request>', page=page).song())
+
+
+def transcribe_song(data):
+    ''' Return tab for a JSON-encoded Song, as described above '''
+    request = json.loads(data)
+    if not isinstance(request, dict):
+        raise ValueError('Expected a JSON object')
+    if 'notes' in request:
+        song = music.Song([music.Chord(note) if isinstance(note, list)
+                           else note for note in request['notes']])
+    else:
+        song = music.Song.from_values(request['values'],
+                                      request.get('durations', 1/4))
+    return arrange(song)
+
+
+def arrange(song):
+    ''' Return tab for a Song. Raises ValueError if any chord is unplayable
+    in standard tuning, since Guitarist would drop every passage around it,
+    losing playable chords too. '''
+    unplayable = [str(chord) for chord in song if not chord.shapes]
+    if unplayable:
+        raise ValueError(f'Unplayable chords: {", ".join(unplayable)}')
+    return str(player.Guitarist(song).arr)
+
+
+ROUTES = {'/image': transcribe_image, '/song': transcribe_song}
+
+
+class HTTPError(Exception):
+    ''' A request which can't be read, to be answered with status '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Metrics():
+    ''' Counts of responses by status, and the latencies of recent
+    requests, from receipt to response, and of the part spent queued '''
+    def __init__(self, window=10000):
+        self.statuses = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+        self.waits = collections.deque(maxlen=window)
+        self.started = time.perf_counter()
+
+    def record(self, status, latency, wait=None):
+        ''' Count a response, keeping the latency of transcriptions, which
+        are the only requests to wait for a worker '''
+        self.statuses[status] += 1
+        if status == 200 and wait is not None:
+            self.latencies.append(latency)
+            self.waits.append(wait)
+
+    def report(self, **extra):
+        ''' Return a JSON-compatible dict of counts and percentiles, in ms '''
+        report = {'uptime': time.perf_counter() - self.started,
+                  'responses': {str(k): v for k, v in
+                                sorted(self.statuses.items())}}
+        for name, times in (('latency', self.latencies), ('wait', self.waits)):
+            if times:
+                report[name] = percentiles(times)
+                report[name]['max'] = 1000 * max(times)
+        report.update(extra)
+        return report
+
+
+class Service():
+    ''' An asyncio server dispatching transcription to an executor, by
+    default a pool of worker processes. workers requests are processed at
+    once, and up to queue more may wait for them. '''
+    def __init__(self, workers=None, queue=16, executor=None,
+                 routes=ROUTES, max_body=MAX_BODY):
+        if queue < 1:
+            # asyncio.Queue(0) is unbounded, so nothing would be refused
+            raise ValueError(f'queue must be at least 1, not {queue}')
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = queue
+        self.executor = executor
+        self.routes = routes
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self.server = None
+        self.connections = set()  # Tasks serving each open connection
+
+    def __repr__(self):
+        return f'Service(workers={self.workers}, queue={self.queue})'
+
+    async def start(self, port=PORT, host='127.0.0.1', path=None):
+        ''' Start listening on a TCP port, or a Unix socket path, and return
+        the asyncio Server. port 0 picks a free port. '''
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        self.jobs = asyncio.Queue(self.queue)
+        self.busy = 0
+        self.tasks = [asyncio.create_task(self._work())
+                      for _ in range(self.workers)]
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._serve, path)
+        else:
+            self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        self.server.close()
+        tasks = [*self.connections, *self.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+        self.executor.shutdown(cancel_futures=True)
+
+    async def _work(self):
+        ''' Run queued jobs in the executor, one at a time '''
+        loop = asyncio.get_running_loop()
+        while True:
+            func, data, future, queued = await self.jobs.get()
+            if future.cancelled():  # The client went away
+                continue
+            started = time.perf_counter()
+            self.busy += 1
+            try:
+                result = await loop.run_in_executor(self.executor, func, data)
+            except Exception as error:
+                if not future.cancelled():
+                    future.set_exception(error)
+            else:
+                if not future.cancelled():
+                    future.set_result((result, started - queued))
+            finally:
+                self.busy -= 1
+
+    async def _serve(self, reader, writer):
+        ''' Answer requests on one connection until the client closes it '''
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.max_body)
+                except HTTPError as error:
+                    self.metrics.record(error.status, None)
+                    await write_response(writer, error.status, f'{error}\n',
+                                         close=True)
+                    break
+                if request is None:
+                    break
+                method, target, headers, data = request
+                received = time.perf_counter()
+                status, body, wait = await self._respond(method, target, data)
+                self.metrics.record(status, time.perf_counter() - received, wait)
+                close = headers.get('connection', '').lower() == 'close'
+                content = ('application/json' if target == '/metrics'
+                           else 'text/plain; charset=utf-8')
+                await write_response(writer, status, body, content, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.CancelledError):
+            pass  # The client went away, or the service is closing
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def _respond(self, method, target, data):
+        ''' Return (status, body, seconds queued) for a request '''
+        if target == '/metrics':
+            report = self.metrics.report(queued=self.jobs.qsize(),
+                                         busy=self.busy, workers=self.workers,
+                                         queue=self.queue)
+            return 200, json.dumps(report), None
+        try:
+            func = self.routes[target]
+        except KeyError:
+            return 404, f'No such endpoint: {target}\n', None
+        if method != 'POST':
+            return 405, 'Use POST\n', None
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.jobs.put_nowait((func, data, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            return 503, 'Too many requests queued, try again later\n', None
+        try:
+            result, wait = await future
+        except (ValueError, KeyError, TypeError) as error:
+            return 400, f'{error}\n', None
+        except Exception as error:
+            return 500, f'{type(error).__name__}: {error}\n', None
+        return 200, result, wait
+
+
+async def read_request(reader, max_body=MAX_BODY):
+    ''' Return (method, target, headers, body) of the next HTTP request,
+    or None at the end of the stream. Raises HTTPError for requests which
+    can't be read. '''
+    line = await read_line(reader)
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, 'Malformed request line')
+    headers = {}
+    for count in range(MAX_HEADERS + 1):
+        line = await read_line(reader)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if count == MAX_HEADERS:
+            raise HTTPError(400, f'Requests are limited to {MAX_HEADERS} headers')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(400, 'Invalid Content-Length')
+    if length > max_body:
+        raise HTTPError(413, f'Requests are limited to {max_body} bytes')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target, headers, body
+
+
+async def read_line(reader):
+    ''' Return the next line from reader, raising HTTPError if it is longer
+    than the reader's buffer limit '''
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError):
+        raise HTTPError(400, 'Line too long')
+
+
+async def write_response(writer, status, body, content='text/plain; charset=utf-8',
+                         close=False):
+    if isinstance(body, str):
+        body = body.encode()
+    head = [f'HTTP/1.1 {status} {REASONS[status]}',
+            f'Content-Type: {content}', f'Content-Length: {len(body)}']
+    if status == 503:
+        head.append('Retry-After: 1')
+    if close:
+        head.append('Connection: close')
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+    await writer.drain()
+
+
+async def connect(port=PORT, host='127.0.0.1', path=None):
+    ''' Return a (reader, writer) pair connected to a Service '''
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+
+async def request(reader, writer, method, target, body=b''):
+    ''' Send one request over an open connection, and return its
+    (status, body) response '''
+    writer.write(f'{method} {target} HTTP/1.1\r\nHost: localhost\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def load_test(target, body, requests=100, concurrency=8,
+                    port=PORT, path=None):
+    ''' Send requests copies of one request to a Service, from concurrency
+    connections at once, each waiting for a response before sending its
+    next request. Returns a dict of throughput and latency percentiles. '''
+    latencies = []
+    statuses = collections.Counter()
+    remaining = iter(range(requests))
+
+    async def client():
+        reader, writer = await connect(port, path=path)
+        try:
+            for _ in remaining:
+                start = time.perf_counter()
+                status, _ = await request(reader, writer, 'POST', target, body)
+                statuses[status] += 1
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    report = {'requests': requests, 'concurrency': concurrency,
+              'seconds': elapsed, 'throughput': statuses[200] / elapsed,
+              'responses': {str(k): v for k, v in sorted(statuses.items())}}
+    if latencies:
+        report['latency'] = percentiles(latencies)
+    return report
+
+
+def percentiles(seconds):
+    ''' Return the median, 95th and 99th percentiles of durations, in ms '''
+    p50, p95, p99 = np.percentile(list(seconds), (50, 95, 99)).tolist()
+    return {'p50': 1000 * p50, 'p95': 1000 * p95, 'p99': 1000 * p99}
+
+
+def _address(arg):
+    ''' Return (port, path) for a command line port number or socket path '''
+    return (int(arg), None) if arg.isdigit() else (None, arg)
+
+
+async def serve(port=PORT, path=None, workers=None, queue=16):
+    service = Service(workers, queue)
+    await service.start(port, path=path)
+    print(f'{service} listening on {path or service.address}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['load']:
+        port, path = _address(sys.argv[2] if len(sys.argv) > 2 else str(PORT))
+        requests = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+        concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+        if len(sys.argv) > 5:
+            with open(sys.argv[5], 'rb') as f:
+                target, body = '/image', f.read()
+        else:
+            target, body = '/song', json.dumps(
+                {'notes': ['E3', 'G3', 'A3', 'B3', 'E4', ['G3', 'B3', 'D4']]}
+            ).encode()
+        print(json.dumps(asyncio.run(load_test(
+            target, body, requests, concurrency, port or PORT, path)), indent=2))
+    else:
+        port, path = _address(sys.argv[1] if len(sys.argv) > 1 else str(PORT))
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        queue = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+        try:
+            asyncio.run(serve(port, path, workers, queue))
+        except KeyboardInterrupt:
+            pass
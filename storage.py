@@ -0,0 +1,104 @@
+'''
+This file concerns storage of Songs and Arrangements in a compact binary
+format, so that detection, arranging and transcription may be run as
+separate stages, each reusing the saved results of the last.
+
+Each file consists of an 8 byte magic string, a little-endian uint32 header
+length, and a JSON header describing the raw arrays which follow it. Every
+array is aligned to ALIGN bytes, so they may be memory-mapped in place.
+'''
+
+import json
+import os
+import struct
+import numpy as np
+import music, tab
+
+VERSION = 1
+ALIGN = 64
+SONG = b'TABSONG\0'
+ARRANGEMENT = b'TABARR\0\0'
+
+
+def save_song(path, song):
+    ''' Write the pitches and durations of song to path '''
+    write(path, SONG, {'values': song.values.astype('<i2'),
+                       'offsets': song.offsets.astype('<i8'),
+                       'durations': song.durations.astype('<f8')})
+
+
+def load_song(path, mmap=True):
+    ''' Read a Song from path. Its arrays are read-only views directly into
+    the file unless mmap is False, in which case they are loaded in full '''
+    arrays, _ = read(path, SONG, mmap)
+    return music.Song.from_arrays(arrays['values'], arrays['offsets'],
+                                  arrays['durations'])
+
+
+def save_arrangement(path, arr):
+    ''' Write the shapes and durations of arrangement arr to path.
+    Shapes are stored as rows of 6 frets, with -1 for unplayed strings '''
+    frets = [[-1 if f is None else f for f in tab.Shape(shape).list_frets()]
+             for shape, _ in arr.notes]
+    write(path, ARRANGEMENT,
+          {'frets': np.array(frets, '<i1').reshape(-1, 6),
+           'durations': np.array([d for _, d in arr.notes], '<f8')},
+          width=arr.width)
+
+
+def load_arrangement_arrays(path, mmap=True):
+    ''' Return the (frets, durations) arrays of a saved Arrangement, plus
+    its width, without constructing any Shapes '''
+    arrays, header = read(path, ARRANGEMENT, mmap)
+    return arrays['frets'], arrays['durations'], header['width']
+
+
+def load_arrangement(path, mmap=True):
+    ''' Read an Arrangement from path, ready for transcription '''
+    frets, durations, width = load_arrangement_arrays(path, mmap)
+    notes = [(tab.Shape([None if f < 0 else f for f in row]), d)
+             for row, d in zip(frets.tolist(), durations.tolist())]
+    return tab.Arrangement(notes=notes, width=width)
+
+
+def write(path, magic, arrays, **attrs):
+    ''' Write a dict of named arrays to path, preceded by a header
+    containing their layout and any extra JSON-compatible attrs '''
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps(dict(attrs, version=VERSION, arrays=layout)).encode()
+    start = -(-(len(magic) + 4 + len(header)) // ALIGN) * ALIGN
+    header += b' ' * (start - len(magic) - 4 - len(header))
+    with open(path, 'wb') as f:
+        f.write(magic + struct.pack('<I', len(header)) + header)
+        for array in arrays.values():
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data + b'\0' * (-len(data) % ALIGN))
+
+
+def read(path, magic, mmap=True):
+    ''' Return a dict of the named arrays in path, plus its header dict.
+    Raises ValueError if the file is not of the expected kind. '''
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f'{path} is not a {magic.rstrip(bytes(1)).decode()} file')
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size))
+        if header['version'] > VERSION:
+            raise ValueError(f'{path} has unsupported version {header["version"]}')
+        if not mmap:
+            data = np.frombuffer(f.read(), np.uint8)
+    start = len(magic) + 4 + size
+    if mmap and os.path.getsize(path) > start:  # Can't map empty regions
+        data = np.memmap(path, np.uint8, 'r', offset=start)
+    elif mmap:
+        data = np.empty(0, np.uint8)
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = data[offset:offset+count].view(dtype).reshape(shape)
+    return arrays, header
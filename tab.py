@@ -12,6 +12,8 @@ into the tablature format commonly used in the guitar community.
 |--------|--------|--------|--------|--------|--------|--------|--------|
 '''
 
+import instrument
+
 MIN_WIDTH = 8  # Minimum size for sparse or empty bars
 MAX_WIDTH = 67  # 64 chars (2 * 32 chars/bar) + 3 barlines
 
@@ -127,6 +129,7 @@ class Arrangement():
             for note in notes:
                 self.add_shape(*note)
 
+    @instrument.timed('tab.Arrangement.render')
     def __repr__(self):
         return '\n'.join(str(staff) for staff in self.staffs)+'\n'
 
@@ -161,6 +164,8 @@ class Arrangement():
 
 class Shape():
     ''' Intended to simplify communication of fretboard coordinates'''
+    __slots__ = ('shape',)
+
     def __init__(self, shape=None):
         '''Converts and stores shape as a fret-list by default'''
         self.shape = [None] * 6
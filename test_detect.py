@@ -1,4 +1,9 @@
 import unittest
+import gc
+import os
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import detect
 import music
@@ -35,17 +40,28 @@ class TestNotes(unittest.TestCase):
                 self.note_size = 1
         self.d = Dummy()
 
+    def peaks(self, points):
+        x, y = zip(*points) if points else ((), ())
+        return detect.make_peaks(x, y, np.ones(len(points)))
+
     def test_null_chord_groups(self):
-        arr = np.zeros([1,6])
-        self.assertEqual(self.d.group_chords(arr), [[]])
+        self.assertEqual(self.d.group_chords(self.peaks([])), [[]])
 
     def test_one_note_chord_groups(self):
-        arr = np.array([[0,1,0,0,1,0]])
-        self.assertEqual(self.d.group_chords(arr), [[(1,0)], [(4,0)]])
+        peaks = self.peaks([(4,0), (1,0)])
+        self.assertEqual(self.d.group_chords(peaks), [[(1,0)], [(4,0)]])
 
     def test_two_note_chord_groups(self):
-        arr = np.array([[0,1,0,0,1,0], [0,0,0,0,0,0], [0,1,0,0,1,0]])
-        self.assertEqual(self.d.group_chords(arr), [[(1,0), (1,2)], [(4,0), (4,2)]])
+        peaks = self.peaks([(1,0), (4,0), (1,2), (4,2)])
+        self.assertEqual(self.d.group_chords(peaks), [[(1,0), (1,2)], [(4,0), (4,2)]])
+
+    def test_find_peaks(self):
+        array = np.zeros((5, 8), np.float32)
+        array[1, 1], array[1, 2], array[3, 6] = 0.6, 0.9, 0.7
+        peaks = self.d.find_peaks(array, 3)
+        self.assertEqual(peaks.dtype, detect.PEAK_DTYPE)
+        self.assertEqual(peaks.tolist(), [(2, 1, np.float32(0.9)),
+                                          (6, 3, np.float32(0.7))])
 
     def test_note_naming(self):
         points = [(0,-110), (0,0), (0,20), (0,30), (0,70), (0,140)]
@@ -53,6 +69,233 @@ class TestNotes(unittest.TestCase):
         names = self.d.name_notes(points, key)
         notes = [music.Note(i) for i in ('C7', 'F5', 'D5', 'C5', 'F4', 'F3')]
         self.assertEqual(names, notes)
+        self.assertEqual([n.name for n in names], [n.name for n in notes])
+
+    def test_pitch_values(self):
+        ys = np.array([-110, 0, 20, 30, 70, 140])
+        values = self.d.pitch_values(ys, (0, 80))
+        self.assertEqual(values.tolist(), [36, 17, 14, 12, 5, -7])
+
+
+class TestLines(unittest.TestCase):
+    def setUp(self):
+        self.d = detect.StaffDetector.__new__(detect.StaffDetector)
+
+    def test_filter_lines(self):
+        hough = np.array([[[0, 52, 900, 52]], [[0, 10, 900, 10]],
+                          [[5, 0, 5, 800]],  # Vertical
+                          [[0, 30, 900, 60]],  # Sloped
+                          [[0, 12, 900, 12]], [[0, 16, 900, 16]]])
+        self.assertEqual(self.d.filter_lines(hough),
+                         ([0, 10, 900, 10], [0, 52, 900, 52]))
+        self.assertEqual(self.d.filter_lines(None), ())
+
+    def test_group_staffs(self):
+        lines = [[0, y, 900, y] for y in (0, 10, 20, 30, 40, 100, 110, 120)]
+        self.assertEqual(self.d.group_staffs(lines[::-1]),
+                         [lines[:5], lines[5:]])
+        self.assertEqual(self.d.group_staffs(lines[:1]), [lines[:1]])
+        self.assertEqual(self.d.group_staffs(()), [[]])
+
+    def test_bounding_box(self):
+        lines = [[10, 5, 900, 6], [0, 20, 800, 19]]
+        self.assertEqual(self.d.get_bounding_box(lines), (0, 5, 900, 20))
+        self.assertEqual(self.d.get_bounding_box([]), ())
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = detect.DetectionCache(self.dir.name)
+        self.image = os.path.join('static', 'kumbayah.png')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_cached_results(self):
+        first = detect.StaffDetector(self.image, self.cache)
+        second = detect.StaffDetector(self.image, self.cache)
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertEqual(first.lines, second.lines)
+        self.assertEqual(first.staff_lines, second.staff_lines)
+        self.assertEqual(first.large_boxes, second.large_boxes)
+        for a, b in zip(first.staffs, second.staffs):
+            self.assertTrue(np.array_equal(a.notes, b.notes))
+            self.assertEqual(a.chord_groups, b.chord_groups)
+            self.assertEqual(a.chords, b.chords)
+
+    def test_params_change_key(self):
+        other = detect.DetectionCache(self.dir.name, threshold=0.6)
+        self.assertNotEqual(self.cache.key(b'page'), other.key(b'page'))
+
+    def test_eviction(self):
+        self.cache.max_bytes = 1000
+        data = {'array': np.arange(200)}  # Incompressible enough
+        for key in ('a', 'b', 'c'):
+            self.cache.save(key, data)
+            os.utime(self.cache.filename(key), (0, ord(key)))
+        self.cache.evict()
+        self.assertIsNone(self.cache.load('a'))
+        self.assertIsNotNone(self.cache.load('c'))
+
+    def test_corrupt(self):
+        data = {'array': np.arange(200)}
+        with open(self.cache.filename('empty'), 'wb'):
+            pass
+        self.cache.save('torn', data)
+        with open(self.cache.filename('torn'), 'r+b') as f:
+            f.truncate(100)
+        self.cache.save('flipped', data)
+        with open(self.cache.filename('flipped'), 'r+b') as f:
+            f.seek(60)
+            f.write(b'\xff' * 40)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            for key in ('empty', 'torn', 'flipped'):
+                with self.subTest(key=key):
+                    self.assertIsNone(self.cache.load(key))
+                    self.assertFalse(os.path.exists(self.cache.filename(key)))
+            gc.collect()
+        self.assertEqual([str(w.message) for w in caught], [])
+        self.assertIsNone(self.cache.load('missing'))
+
+    def test_evicted_meanwhile(self):
+        self.cache.max_bytes = 0
+        self.cache.save('a', {'array': np.arange(200)})
+        remove = os.remove
+
+        def race(path):
+            remove(path)  # As if another process deleted it first
+            remove(path)
+
+        os.remove = race
+        try:
+            self.cache.save('b', {'array': np.arange(200)})
+        finally:
+            os.remove = remove
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_concurrent_saves(self):
+        rng = np.random.default_rng(0)
+        arrays = [{'array': rng.integers(0, 2**62, 200000)} for _ in range(8)]
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda data: self.cache.save('same', data), arrays))
+        self.assertEqual(os.listdir(self.dir.name), ['same.npz'])
+        saved = self.cache.load('same')['array']
+        self.assertTrue(any(np.array_equal(saved, a['array']) for a in arrays))
+
+
+class TestLowMemory(unittest.TestCase):
+    def test_same_notes(self):
+        for name in ('line', 'kumbayah'):
+            with self.subTest(i=name):
+                image = os.path.join('static', f'{name}.png')
+                default = detect.StaffDetector(image).export()
+                low = detect.StaffDetector(image, low_memory=True).export()
+                # Match scores may differ slightly, but not the notes found
+                del default['note_scores'], low['note_scores']
+                for key in default:
+                    self.assertTrue(np.array_equal(default[key], low[key]))
+
+    def test_released(self):
+        d = detect.StaffDetector(os.path.join('static', 'line.png'),
+                                 low_memory=True)
+        self.assertIs(d.image, d.gray)
+        self.assertEqual(d.gray.ndim, 2)
+        self.assertIsNone(d.edges)
+        self.assertEqual(d.staffs[0].notes['score'].dtype, np.float32)
+
+    def test_cache_key(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = detect.DetectionCache(folder)
+            self.assertNotEqual(cache.key(b'page'),
+                                cache.key(b'page', low_memory=True))
+
+
+class TestPrefilter(unittest.TestCase):
+    def test_same_notes(self):
+        for name in ('ignite', 'romance'):
+            with self.subTest(i=name):
+                image = os.path.join('static', f'{name}.png')
+                default = detect.StaffDetector(image).export()
+                filtered = detect.StaffDetector(image, prefilter=True).export()
+                # Scores of smaller matches may differ by rounding
+                self.assertTrue(np.allclose(default.pop('note_scores'),
+                                            filtered.pop('note_scores'),
+                                            atol=1e-4))
+                for key in default:
+                    self.assertTrue(np.array_equal(default[key], filtered[key]))
+
+    def test_candidate_columns(self):
+        d = detect.StaffDetector(os.path.join('static', 'romance.png'))
+        for staff in d.staffs:
+            columns = staff.candidate_columns()
+            self.assertEqual(columns, sorted(columns))
+            self.assertTrue(all(x0 < x1 for x0, x1 in columns))
+            self.assertLessEqual(sum(x1 - x0 for x0, x1 in columns),
+                                 staff.gray.shape[1])
+            for x in staff.notes['x'].tolist():
+                self.assertTrue(any(x0 <= x < x1 for x0, x1 in columns))
+
+    def test_cache_key(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = detect.DetectionCache(folder)
+            self.assertNotEqual(cache.key(b'page'),
+                                cache.key(b'page', prefilter=True))
+
+
+class TestThreads(unittest.TestCase):
+    def test_same_results(self):
+        image = os.path.join('static', 'rosita.png')
+        default = detect.StaffDetector(image)
+        self.assertGreater(len(default.staffs), 2)
+        for threads in (3, None):
+            with self.subTest(i=threads):
+                threaded = detect.StaffDetector(image, threads=threads)
+                self.assertEqual([s.n for s in threaded.staffs],
+                                 list(range(len(default.staffs))))
+                expected, found = default.export(), threaded.export()
+                for key in expected:
+                    self.assertTrue(np.array_equal(expected[key], found[key]))
+
+
+class TestPageLoader(unittest.TestCase):
+    def setUp(self):
+        self.names = [os.path.join('static', f'{name}.png')
+                      for name in ('line', 'star', 'ignite')]
+
+    def test_order(self):
+        for low_memory in (False, True):
+            loader = detect.PageLoader(self.names, 1, low_memory)
+            loaded = list(loader)
+            self.assertEqual([name for name, _ in loaded], self.names)
+            for name, (data, image, gray) in loaded:
+                expected = detect.load_page(name, low_memory)
+                self.assertEqual(data, expected[0])
+                self.assertTrue(np.array_equal(image, expected[1]))
+                self.assertTrue(np.array_equal(gray, expected[2]))
+            self.assertEqual(loader.report()['pages'], 3)
+
+    def test_same_results(self):
+        name, page = next(iter(detect.PageLoader(self.names[:1])))
+        loaded = detect.StaffDetector(name, page=page).export()
+        expected = detect.StaffDetector(name).export()
+        for key in expected:
+            self.assertTrue(np.array_equal(expected[key], loaded[key]))
+
+    def test_missing(self):
+        loader = detect.PageLoader([self.names[0], 'missing.png'])
+        pages = iter(loader)
+        self.assertEqual(next(pages)[0], self.names[0])
+        with self.assertRaises(FileNotFoundError):
+            next(pages)
+
+    def test_stop_early(self):
+        loader = detect.PageLoader(self.names * 10, 2)
+        for name, page in loader:
+            break
+        self.assertEqual(len(loader.depths), 1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+import unittest
+import os
+import tempfile
+import differential
+import player
+
+
+class TestCompare(unittest.TestCase):
+    def test_differences(self):
+        result = differential.compare(
+            'double', [1, 2, 3], lambda cases: [2 * x for x in cases],
+            lambda cases: [x + x for x in cases[:2]] + [0])
+        self.assertEqual((result.cases, result.different), (3, 1))
+        self.assertFalse(result.ok)
+        self.assertEqual(result.examples, ['3: expected 6, found 0'])
+        self.assertIn('1 different', repr(result))
+
+    def test_better(self):
+        result = differential.compare(
+            'scores', [1, 2], lambda cases: [5, 5], lambda cases: [5, 4],
+            better=lambda a, b: b < a)
+        self.assertTrue(result.ok)
+        self.assertEqual((result.different, result.better), (0, 1))
+
+    def test_approximate(self):
+        result = differential.compare('rough', [1], lambda cases: [1],
+                                      lambda cases: [2], exact=False)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.different, 1)
+
+
+class TestChecks(unittest.TestCase):
+    def test_voicings(self):
+        result = differential.check_voicings(100, seed=1)
+        self.assertTrue(result.ok, result.examples)
+
+    def test_reference_voicings(self):
+        # E major, open
+        self.assertIn((0, 2, 2, 1, 0, 0),
+                      differential.reference_voicings((-8, -1, 4, 8, 11, 16)))
+        self.assertEqual(differential.reference_voicings((-9,)), set())
+
+    def test_positions(self):
+        result = differential.check_positions(100, seed=1)
+        self.assertTrue(result.ok, result.examples)
+
+    def test_steps(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'steps.bin')
+            player.build_table(path, max_notes=1, distance=1)
+            table = player.StepTable(path)
+            results = differential.check_steps(500, seed=1, table=table)
+        self.assertIn('StepTable.lookup', [r.name for r in results])
+        for result in results:
+            self.assertTrue(result.ok, result.examples)
+
+    def test_engines(self):
+        for result in differential.check_engines(3, 6, seed=1):
+            self.assertTrue(result.ok, result.examples)
+            self.assertEqual(result.cases, 3)
+
+    def test_detection(self):
+        pages = [os.path.join('static', f'{name}.png')
+                 for name in ('line', 'star')]
+        results = differential.check_detection(pages)
+        for result in results:
+            self.assertTrue(result.ok, result.examples)
+            self.assertEqual(result.cases, 2)
+        self.assertEqual([r.exact for r in results],
+                         [True, True, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
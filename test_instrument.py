@@ -0,0 +1,104 @@
+import unittest, os, tempfile, threading, instrument, music, player
+
+
+class TestInstrument(unittest.TestCase):
+    def test_disabled(self):
+        self.assertFalse(instrument.ENABLED)
+        before = instrument.STATS.report()
+        with instrument.timer('nothing'):
+            instrument.count('nothing')
+        self.assertEqual(instrument.STATS.report(), before)
+
+    def test_timers(self):
+        @instrument.timed('double')
+        def double(x):
+            return 2 * x
+
+        with instrument.collect() as stats:
+            self.assertEqual(double(2), 4)
+            with instrument.timer('block'):
+                double(3)
+            instrument.count('things')
+            instrument.count('things', 2)
+        self.assertFalse(instrument.ENABLED)
+        double(4)
+        self.assertEqual(stats.timers['double'][0], 2)
+        self.assertEqual(stats.timers['block'][0], 1)
+        self.assertGreaterEqual(stats.timers['block'][1], 0)
+        self.assertEqual(stats.counters, {'things': 3})
+
+    def test_nested(self):
+        with instrument.collect() as outer:
+            instrument.count('a')
+            with instrument.collect() as inner:
+                instrument.count('b')
+            instrument.count('a')
+        self.assertEqual(outer.counters, {'a': 2})
+        self.assertEqual(inner.counters, {'b': 1})
+        outer.merge(inner)
+        self.assertEqual(outer.counters, {'a': 2, 'b': 1})
+
+    def test_threads(self):
+        def work():
+            for _ in range(1000):
+                instrument.count('things')
+                with instrument.timer('block'):
+                    pass
+
+        with instrument.collect() as stats:
+            threads = [threading.Thread(target=work) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(stats.counters, {'things': 4000})
+        self.assertEqual(stats.timers['block'][0], 4000)
+
+    def test_merge_while_timing(self):
+        stats, worker = instrument.Stats(), instrument.Stats()
+        for i in range(100):
+            worker.add_time(f'worker {i}', 0.5)
+            worker.count('merged')
+
+        def work(n):
+            for i in range(2000):
+                stats.add_time(f'block {n} {i % 50}', 0.0)
+                stats.count('things')
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for _ in range(50):
+            stats.merge(worker)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stats.counters, {'things': 8000, 'merged': 5000})
+        self.assertEqual(stats.timers['worker 0'], [50, 25.0])
+        self.assertEqual(sum(calls for name, (calls, _) in stats.timers.items()
+                             if name.startswith('block')), 8000)
+        stats.merge(stats)  # Doesn't deadlock
+        self.assertEqual(stats.counters['things'], 16000)
+
+    def test_save(self):
+        with instrument.collect() as stats:
+            with instrument.timer('block'):
+                instrument.count('things', 5)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'stats.json')
+            stats.save(path)
+            loaded = instrument.Stats.load(path)
+        self.assertEqual(loaded.report(), stats.report())
+
+    def test_guitarist(self):
+        song = music.Song(['E3', 'G3', 'A3', 'B3', 'E4'])
+        with instrument.collect() as stats:
+            arr = player.Guitarist(song).arr
+            str(arr)
+        self.assertEqual(stats.timers['player.Guitarist.read'][0], 1)
+        self.assertGreater(stats.timers['player.Guitarist.play'][0], 1)
+        self.assertEqual(stats.timers['tab.Arrangement.render'][0], 1)
+        self.assertEqual(stats.counters['player.passage_misses'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
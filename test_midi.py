@@ -0,0 +1,82 @@
+import unittest, os, struct, tempfile
+import midi, music
+
+
+def varlen(value):
+    data = [value & 0x7F]
+    while value > 0x7F:
+        value >>= 7
+        data.insert(0, (value & 0x7F) | 0x80)
+    return bytes(data)
+
+
+def track(events):
+    ''' events is a list of (delta ticks, event bytes) '''
+    data = b''.join(varlen(delta) + event for delta, event in events)
+    data += b'\x00\xff\x2f\x00'  # End of track
+    return b'MTrk' + struct.pack('>I', len(data)) + data
+
+
+def midi_file(tracks, division=96):
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), division)
+    return header + b''.join(tracks)
+
+
+class TestMidiImport(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'test.mid')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def test_single_notes(self):
+        # E3, then G3, as quarter notes, using running status for note-off
+        self.write(midi_file([track([
+            (0, b'\x90\x34\x40'), (96, b'\x34\x00'),
+            (0, b'\x90\x37\x40'), (96, b'\x80\x37\x40')])]))
+        song = midi.read_song(self.path)
+        self.assertEqual(song.notes, [music.Chord(['E3']), music.Chord(['G3'])])
+
+    def test_chords_across_tracks(self):
+        # An E5 power chord split over two tracks, then an eighth note A3
+        self.write(midi_file([
+            track([(0, b'\xff\x51\x03\x07\xa1\x20'),  # Tempo, ignored
+                   (0, b'\x90\x34\x40'), (192, b'\x80\x34\x00')]),
+            track([(1, b'\x91\x3b\x40'), (95, b'\x90\x39\x40'),
+                   (48, b'\x81\x3b\x00'), (0, b'\x80\x39\x00')])]))
+        song = midi.read_song(self.path)
+        self.assertEqual(song.pitches(), [(-8, -1), (-3,)])
+        self.assertEqual(song.durations.tolist(), [1/4, 1/8])
+
+    def test_drums_ignored(self):
+        self.write(midi_file([track([
+            (0, b'\x99\x24\x40'), (0, b'\x90\x34\x40'), (96, b'\x80\x34\x00')])]))
+        self.assertEqual(midi.read_song(self.path).pitches(), [(-8,)])
+
+    def test_quantize(self):
+        self.write(midi_file([track([
+            (0, b'\x90\x34\x40'), (50, b'\x90\x37\x40'), (46, b'\x80\x34\x00'),
+            (0, b'\x80\x37\x00')])]))
+        song = midi.read_song(self.path, quantize=1/8)
+        self.assertEqual(song.durations.tolist(), [1/8, 1/8])
+
+    def test_counters(self):
+        self.write(midi_file([track([(0, b'\x90\x34\x40'), (96, b'\x80\x34\x00')])]))
+        m = midi.MidiFile(self.path)
+        m.song()
+        self.assertEqual(m.events, 3)
+        self.assertGreater(m.rate, 0)
+
+    def test_not_midi(self):
+        self.write(b'RIFF' + bytes(20))
+        with self.assertRaises(ValueError):
+            midi.MidiFile(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,15 @@ class TestNotes(unittest.TestCase):
         e6 = music.Note('E6')
         self.assertEqual(e6.shapes, [(4,17), (5,12)])
 
+    def test_diatonic_values(self):
+        names = ['A2', 'B2', 'C3', 'B3', 'C4', 'D4', 'B4', 'C5', 'D6']
+        values = music.diatonic_values([-9, -8, -7, -1, 0, 1, 6, 7, 15])
+        self.assertEqual(values.tolist(), [music.Note(n).value for n in names])
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.e1, '__dict__'))
+        self.assertFalse(hasattr(music.Chord(['E3', 'B3']), '__dict__'))
+
 
 class TestChordShapes(unittest.TestCase):
     def setUp(self):
@@ -74,6 +83,112 @@ class TestChordShapes(unittest.TestCase):
                                       [1, None, None, None, None, 1]])
 
 
+class TestSongArrays(unittest.TestCase):
+    def setUp(self):
+        self.song = music.Song(['E3', music.Chord(['C4', 'E4']),
+                                music.Note('G4', 1/8)])
+
+    def test_arrays(self):
+        self.assertEqual(self.song.values.tolist(), [-8, 0, 4, 7])
+        self.assertEqual(self.song.offsets.tolist(), [0, 1, 3, 4])
+        self.assertEqual(self.song.durations.tolist(), [1/4, 1/4, 1/8])
+
+    def test_from_values(self):
+        song = music.Song.from_values([-8, [0, 4], 7], [1/4, 1/4, 1/8])
+        self.assertEqual(song.notes, self.song.notes)
+        single = music.Song.from_values([-8, 0, 4])
+        self.assertEqual(single.offsets.tolist(), [0, 1, 2, 3])
+        self.assertEqual(single.durations.tolist(), [1/4] * 3)
+
+    def test_from_arrays(self):
+        song = music.Song.from_arrays([-8, 0, 4, 7], [0, 1, 3, 4], [1/4, 1/4, 1/8])
+        self.assertEqual(song.notes, self.song.notes)
+        with self.assertRaises(ValueError):
+            music.Song.from_arrays([-8, 0], [0, 1, 3], [1/4, 1/4])
+
+    def test_add_after_bulk(self):
+        song = music.Song.from_values([-8, 0])
+        song.add('E4')
+        self.assertEqual(len(song), 3)
+        self.assertEqual(song.values.tolist(), [-8, 0, 4])
+        self.assertEqual(song[2], music.Chord(['E4']))
+
+    def test_transpose(self):
+        up = self.song.transpose(2)
+        self.assertEqual(up.values.tolist(), [-6, 2, 6, 9])
+        self.assertEqual(up[1], music.Chord(['D4', 'F#4']))
+        self.assertEqual(self.song.values.tolist(), [-8, 0, 4, 7])
+
+    def test_slices(self):
+        self.assertEqual(self.song[1:].notes, self.song.notes[1:])
+        self.assertEqual(self.song[::-1].notes, self.song.notes[::-1])
+        self.assertEqual(self.song[::2].values.tolist(), [-8, 7])
+        self.assertEqual(self.song[-1], self.song.notes[-1])
+        self.assertEqual(len(self.song[5:]), 0)
+
+
+class TestSongRepeats(unittest.TestCase):
+    def test_repeats(self):
+        song = music.Song(['E3', 'G3', music.Chord(['A3', 'E4']), 'E3', 'G3'])
+        self.assertEqual(song.pitches(), [(-8,), (-5,), (-3, 4), (-8,), (-5,)])
+        self.assertEqual(song.repeats(2), {((-8,), (-5,)): [0, 3]})
+        self.assertEqual(song.repeats(3), {})
+
+
+class TestVoicings(unittest.TestCase):
+    def test_capo(self):
+        tuning = tuple(music.STD_TUNING)
+        music.get_voicings.cache_clear()
+        lower = music.get_voicings((-3, 4), tuning)
+        capo = music.get_voicings((-1, 6), tuning, 2)
+        self.assertEqual([s.list_frets() for s in capo],
+                         [s.list_frets() for s in lower])
+        # The capo position reused the voicings of the chord a tone lower
+        self.assertEqual(music.get_voicings.cache_info().hits, 1)
+        # One fret past the end of the high E string, which a capo doesn't move
+        past = music.LOW_E + tuning[5] + music.MAX_FRET + 1
+        frets = [None] * 5 + [music.MAX_FRET - 1]
+        self.assertIn(frets, [s.list_frets() for s in
+                              music.get_voicings((past - 2,), tuning)])
+        self.assertNotIn(frets, [s.list_frets() for s in
+                                 music.get_voicings((past,), tuning, 2)])
+
+
+class TestVoicingIndex(unittest.TestCase):
+    def setUp(self):
+        self.chord = music.Chord(['A3', 'E4'])
+        values = tuple(note.value for note in self.chord.notes)
+        self.index = music.get_voicing_index(values)
+
+    def frets(self, shapes):
+        return [shape.list_frets() for shape in shapes]
+
+    def test_all(self):
+        self.assertEqual(self.frets(self.index.query(0, music.MAX_FRET)),
+                         self.frets(self.chord.get_shapes()))
+
+    def test_range(self):
+        for frets in self.frets(self.index.query(5, 9)):
+            self.assertTrue(all(5 <= f <= 9 for f in frets if f))
+        # Open strings fit any position
+        open_a = [None, 0, 2, None, None, None]
+        self.assertIn(open_a, self.frets(self.index.query(1, 4)))
+        self.assertNotIn(open_a, self.frets(self.index.query(5, 9)))
+
+    def test_strings(self):
+        shapes = self.index.query(0, music.MAX_FRET, strings={1, 2})
+        self.assertTrue(shapes)
+        for frets in self.frets(shapes):
+            self.assertEqual([s for s, f in enumerate(frets) if f is not None],
+                             [1, 2])
+
+    def test_fallback(self):
+        # Nothing fits within the first 2 frets, so every voicing is offered
+        high = music.Chord(['D5', 'F#5'])
+        self.assertEqual(self.frets(high.get_shapes(position=(0, 2))),
+                         self.frets(high.get_shapes()))
+
+
 if __name__ == '__main__':
     all_open = [(0,0), (1,0), (2,0), (3,0), (4,0), (5,0)]
     open_c = [(0,0), (1,3), (2,2), (3,0), (4,1), (5,0)]
@@ -1,5 +1,7 @@
-import unittest, player, tab, music
+import unittest, os, tempfile, player, tab, music
 import itertools as it
+import differential
+import numpy as np
 
 class TestFingers(unittest.TestCase):
     def test_null_finger(self):
@@ -8,6 +10,10 @@ class TestFingers(unittest.TestCase):
         self.assertEqual(player.Finger().fret, None)
         self.assertEqual(player.Finger().down, False)
 
+    def test_slots(self):
+        self.assertFalse(hasattr(player.Finger(0, 1), '__dict__'))
+        self.assertFalse(hasattr(player.Hand(), '__dict__'))
+
     def test_init_position(self):
         for string, fret in it.product(range(6), range(12)):
             with self.subTest(i=(string, fret)):
@@ -200,6 +206,228 @@ class TestHandStrain(unittest.TestCase):
         self.assertEqual(h.strain, 6)
 
 
+class TestHandState(unittest.TestCase):
+    def setUp(self):
+        self.shapes = [all_open, open_c, open_a, open_g, open_e, open_d,
+                       barre_b, barre_f, barre_a]
+
+    def test_round_trip(self):
+        for shape in self.shapes:
+            with self.subTest(i=shape):
+                h = player.Hand(shape)
+                copy = player.Hand.from_state(h.state)
+                self.assertEqual(copy.shape, h.shape)
+                self.assertEqual(copy.strain, h.strain)
+                self.assertEqual(copy.state, h.state)
+
+    def test_null_state(self):
+        self.assertEqual(player.Hand().state, 0)
+
+    def test_restore(self):
+        h = player.Hand(open_c)
+        state = h.state
+        self.assertEqual(h.move(open_g), 11)
+        h.restore(state)
+        self.assertEqual(h.shape, open_c)
+        self.assertEqual(h.move(open_g), 11)
+
+    def test_play_matches_replay(self):
+        ''' Branching from states must score paths exactly as replaying them '''
+        song = music.Song([music.Chord(['E3', 'B3']), 'G3', 'D4',
+                           music.Chord(['A3', 'E4', 'A4'])])
+        g = player.Guitarist()
+        best = None
+        for path in it.product(*[chord.shapes for chord in song.notes]):
+            score = g.evaluate(path)
+            if best is None or score < best[0]:
+                best = (score, path)
+        self.assertEqual(g.play(song), best[1])
+
+
+class TestStepTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.dir.name, 'steps.bin')
+        player.build_table(cls.path, max_notes=1, distance=3)
+        cls.table = player.StepTable(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.table  # Release the mapped file
+        cls.dir.cleanup()
+
+    def test_strains(self):
+        for frets in player.voicing_space(1):
+            with self.subTest(i=frets):
+                self.assertEqual(self.table.strain(tuple(frets)),
+                                 player.Hand([t for t in enumerate(frets)
+                                              if t[1] is not None]).strain)
+
+    def test_lookups_match_moves(self):
+        shapes = [tab.Shape(frets) for frets in player.voicing_space(1)]
+        hits = 0
+        for a, b in it.product(shapes[::7], shapes[::5]):
+            with self.subTest(i=(a, b)):
+                hand = player.Hand(a)
+                state = hand.state
+                expected = (hand.move(b) + hand.strain, hand.state)
+                found = self.table.lookup(state, tuple(b.list_frets()))
+                if found is not None:
+                    self.assertEqual(found, expected)
+                    hits += 1
+        self.assertGreater(hits, 0)
+
+    def test_missing(self):
+        self.assertIsNone(self.table.strain(tuple(tab.Shape(open_c).list_frets())))
+        self.assertIsNone(self.table.lookup(12345, (1, None, None, None, None, None)))
+
+    def test_same_path(self):
+        song = music.Song(['E3', 'G3', 'A3', 'B3', 'D4', 'E4', 'D4', 'B3'])
+        expected = player.Guitarist(song).path
+        player._tables[player.TABLE] = self.table
+        try: self.assertEqual(player.Guitarist(song).path, expected)
+        finally: del player._tables[player.TABLE]
+
+
+class TestEngines(unittest.TestCase):
+    def setUp(self):
+        self.songs = [
+            music.Song([music.Note(n, 1/8) for n in
+                        ('E3', 'F#3', 'G#3', 'A3', 'B3', 'C#4', 'D#4', 'E4')]),
+            music.Song([music.Chord(['E3', 'B3', 'E4']), music.Chord(['G3', 'D4', 'G4']),
+                        music.Chord(['A3', 'E4', 'A4']), music.Chord(['E3', 'B3', 'E4'])]),
+            music.Song([music.Chord(['G3', 'B4']), 'G4', music.Chord(['A3', 'C5']),
+                        'G4', music.Chord(['B3', 'D5']), 'G4'])]
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            player.Guitarist(engine='guess')
+
+    def test_astar_play(self):
+        for song in self.songs:
+            with self.subTest(i=song.notes):
+                product = player.Guitarist(engine='product')
+                astar = player.Guitarist(engine='astar')
+                self.assertEqual(astar.play(song), product.play(song))
+                self.assertLess(astar.expanded, product.expanded)
+
+    def test_astar_read(self):
+        for song in self.songs:
+            with self.subTest(i=song.notes):
+                self.assertEqual(player.Guitarist(song, engine='astar').arr,
+                                 player.Guitarist(song).arr)
+
+    def test_dp_play(self):
+        for song in self.songs:
+            product = player.Guitarist().play(song)
+            g = player.Guitarist(engine='dp')
+            paths = [g.voicings(chord) for chord in song]
+            for interval in (None, 1, 2, 3, len(paths)):
+                with self.subTest(i=song.notes, interval=interval):
+                    self.assertEqual(g.play_dp(paths, interval), product)
+
+    def test_dp_read(self):
+        for song in self.songs:
+            with self.subTest(i=song.notes):
+                self.assertEqual(player.Guitarist(song, engine='dp').arr,
+                                 player.Guitarist(song).arr)
+
+    def test_dp_long(self):
+        # Far too many paths for the other engines, but checkpoints
+        # must not change the result
+        song = music.Song(self.songs[2].notes * 20)
+        g = player.Guitarist(engine='dp')
+        paths = [g.voicings(chord) for chord in song]
+        self.assertEqual(g.play_dp(paths), g.play_dp(paths, len(paths)))
+        self.assertIsNone(g.play_dp(paths + [[]]))
+
+    def test_strain_bound(self):
+        for shape in (open_c, open_e, barre_a, barre_f):
+            with self.subTest(i=shape):
+                self.assertLessEqual(player.strain_bound(tab.Shape(shape)),
+                                     player.Hand(shape).strain)
+
+
+class TestStepKernels(unittest.TestCase):
+    def setUp(self):
+        self.pairs = differential.random_moves(2000)
+        self.states = np.array([state for state, _ in self.pairs])
+        self.frets = player.shape_frets([shape for _, shape in self.pairs])
+        self.expected = tuple(
+            list(column) for column in zip(*differential.reference_steps(self.pairs)))
+        self.assertIn(-1, self.expected[1])
+
+    def check(self, kernel):
+        costs, states = kernel(self.states, self.frets)
+        self.assertEqual(costs.tolist(), self.expected[0])
+        self.assertEqual(states.tolist(), self.expected[1])
+
+    def test_numpy(self):
+        self.check(player.score_steps_numpy)
+
+    def test_loop(self):
+        self.check(player.score_steps_loop)
+
+    @unittest.skipUnless(player.numba, 'numba is not installed')
+    def test_numba(self):
+        self.check(player.score_steps)
+
+    def test_contract(self):
+        # The fallback returns what the compiled loop would, even when empty
+        for n in (len(self.states), 0):
+            loop = player.score_steps_loop(self.states[:n], self.frets[:n])
+            fallback = player.score_steps_numpy(self.states[:n], self.frets[:n])
+            for a, b in zip(loop, fallback):
+                self.assertEqual((a.dtype, a.shape), (b.dtype, b.shape))
+                self.assertEqual(a.tolist(), b.tolist())
+
+    def test_relax(self):
+        states = np.unique([s for s in self.expected[1] if s >= 0])[:50]
+        scores = np.arange(len(states), dtype=np.int64) % 7
+        ranks = np.arange(len(states), dtype=np.int64)[::-1].copy()
+        frets = player.shape_frets([tab.Shape(f) for f in (
+            [None, 0, 2, 2, 1, 0], [3, 2, 0, 0, 0, 3], [None, None, 7, 9, 10, 9])])
+        kernel = player.score_steps
+        results = []
+        try:
+            for player.score_steps in (player.score_steps_loop,
+                                       player.score_steps_numpy):
+                results.append(player.relax(states, scores, ranks, frets))
+        finally:
+            player.score_steps = kernel
+        for a, b in zip(*results):
+            self.assertEqual(a.tolist(), b.tolist())
+
+    def test_step(self):
+        g = player.Guitarist()
+        for (state, shape), cost, new in zip(self.pairs[:200], *self.expected):
+            if new >= 0:
+                self.assertEqual(g.step(state, shape), (cost, new))
+
+    def test_bounded_steps(self):
+        moves = [pair for pair, new in zip(self.pairs, self.expected[1])
+                 if new >= 0]
+        unbounded = player.Guitarist()
+        expected = [unbounded.step(state, shape) for state, shape in moves]
+        self.assertGreater(len(unbounded.steps), 16)
+        limit = player.MAX_STEPS
+        player.MAX_STEPS = 16
+        try:
+            g = player.Guitarist()
+            for (state, shape), step in zip(moves, expected):
+                self.assertEqual(g.step(state, shape), step)
+                self.assertLessEqual(len(g.steps), 16)
+        finally:
+            player.MAX_STEPS = limit
+
+    def test_fret_codes(self):
+        shapes = {tuple(shape.list_frets()) for _, shape in self.pairs}
+        codes = {player.fret_code(frets) for frets in shapes}
+        self.assertEqual(len(codes), len(shapes))
+        self.assertLess(max(codes), 2**48)
+
+
 class TestGuitarist(unittest.TestCase):
     def test_null_song(self):
         song = music.Song()
@@ -224,10 +452,7 @@ class TestGuitarist(unittest.TestCase):
     @unittest.expectedFailure
     # TODO select fingers to reduce strain, don't always rely on index
     def test_E_major(self):
-        song = music.Song()
-        for note in ('E3', 'F#3', 'G#3', 'A3', 'B3', 'C#4', 'D#4', 'E4'):
-            song.add(music.Note(note, 1/8))
-        g = player.Guitarist(song)
+        g = player.Guitarist(differential.test_songs()['scale'])
         expected = ('|--------------------------------|\n'
             '|--------------------------------|\n'
             '|--------------------------------|\n'
@@ -241,14 +466,7 @@ class TestGuitarist(unittest.TestCase):
 
     @unittest.expectedFailure
     def test_chords(self):
-        song = music.Song()
-        sotw_chords = [(['E3', 'B3', 'E4'], 1/4), (['G3', 'D4', 'G4'], 1/4),
-                      (['A3', 'E4', 'A4'], 3/8), (['E3', 'B3', 'E4'], 1/4),
-                      (['G3', 'D4', 'G4'], 1/4), (['B3', 'F#4', 'B4'], 1/8),
-                      (['A3', 'E4', 'A4'], 1/2)]
-        for chord in sotw_chords:
-            song.add(music.Chord(*chord))
-        g = player.Guitarist(song)
+        g = player.Guitarist(differential.test_songs()['smoke'])
         try: self.assertEqual(g.arr, smoke_on_the_water)
         except AssertionError as AE:
             print(f'Smoke on the Water, two bars, auto:\n{g.arr}')
@@ -256,20 +474,102 @@ class TestGuitarist(unittest.TestCase):
 
     @unittest.expectedFailure
     def test_mixed_notes(self):
-        song = music.Song()
-        bb_chords = [(['G3', 'B4'], 1/6), (['G4'], 1/6), (['A3', 'C5'], 1/6),
-                     (['G4'], 1/6), (['B3', 'D5'], 1/6), (['G4'], 1/6),
-                     (['G4', 'B5'], 1/4), (['G4'], 1/8), (['B5'], 1/8),
-                     (['G4'], 1/8), (['B5'], 1/8), (['G4'], 1/4)]
-        for chord in bb_chords:
-            song.add(music.Chord(*chord))
-        g = player.Guitarist(song)
+        g = player.Guitarist(differential.test_songs()['blackbird'])
         try: self.assertEqual(g.arr, blackbird)
         except AssertionError as AE:
             print(f'Blackbird, two bars, auto:\n{g.arr}')
             raise AE
 
 
+class TestCapoAndTuning(unittest.TestCase):
+    def setUp(self):
+        self.song = music.Song(['E3', 'G3', 'F#3', 'B3'])
+
+    def test_capo_frets(self):
+        song = music.Song(['F#3'])
+        g = player.Guitarist(song, capo=2)
+        self.assertEqual(g.path, [[0, None, None, None, None, None]])
+
+    def test_drop_d(self):
+        song = music.Song(['D3'])
+        self.assertFalse(player.Guitarist().playable(song))
+        g = player.Guitarist(song, tuning=music.DROP_D_TUNING)
+        self.assertEqual(g.path, [[0, None, None, None, None, None]])
+
+    def test_score(self):
+        g = player.Guitarist(self.song)
+        self.assertEqual(g.score, g.evaluate(g.path))
+        self.assertIsNone(player.Guitarist().score)
+
+    def test_optimize(self):
+        options = player.optimize(self.song, processes=1)
+        scores = [g.score for g in options]
+        self.assertEqual(scores, sorted(scores))
+        # E3 is out of reach with any capo in standard tuning
+        standard = [g.capo for g in options if g.tuning == tuple(music.STD_TUNING)]
+        self.assertEqual(standard, [0])
+        default = player.Guitarist(self.song)
+        self.assertIn((default.score, default.tuning, 0),
+                      [(g.score, g.tuning, g.capo) for g in options])
+
+    def test_optimize_processes(self):
+        serial = player.optimize(self.song, capos=range(3), processes=1)
+        parallel = player.optimize(self.song, capos=range(3), processes=2)
+        self.assertEqual([(g.score, g.tuning, g.capo) for g in serial],
+                         [(g.score, g.tuning, g.capo) for g in parallel])
+
+
+class TestPosition(unittest.TestCase):
+    def setUp(self):
+        self.song = music.Song(['A3', 'B3', 'C#4', 'D4', 'E4'])
+
+    def test_window(self):
+        g = player.Guitarist(self.song, position=(7, 10))
+        frets = [f for shape in g.path for f in shape.list_frets() if f]
+        self.assertTrue(all(7 <= f <= 10 for f in frets))
+
+    def test_default(self):
+        g = player.Guitarist(self.song, position=None)
+        self.assertEqual(g.path, player.Guitarist(self.song).path)
+
+    def test_single_chord(self):
+        g = player.Guitarist(music.Song(['A3']), position=(5, 8))
+        self.assertEqual(g.path, [[5, None, None, None, None, None]])
+
+    def test_processes(self):
+        serial = player.Guitarist(self.song, position=(7, 10))
+        parallel = player.Guitarist(self.song, position=(7, 10), processes=2)
+        self.assertEqual(serial.path, parallel.path)
+
+
+class TestParallelReading(unittest.TestCase):
+    def test_same_path(self):
+        song = music.Song(['E3', 'G3', 'A3', 'B3', 'D4', 'E4', 'G4', 'A4',
+                           music.Chord(['A3', 'E4']), 'G4', 'E4', 'D4'])
+        serial = player.Guitarist(song)
+        parallel = player.Guitarist(song, processes=2)
+        self.assertEqual(serial.path, parallel.path)
+        self.assertEqual(serial.arr, parallel.arr)
+
+
+class TestRepeatedPassages(unittest.TestCase):
+    def setUp(self):
+        verse = ['E3', 'G3', 'A3', music.Chord(['A3', 'E4']), 'B3', 'D4']
+        self.song = music.Song(verse * 3)
+
+    def test_memo_counters(self):
+        g = player.Guitarist(self.song)
+        passages = len(self.song) - 3
+        self.assertEqual(g.memo_hits + g.memo_misses, passages)
+        # One per verse position, plus the shorter opening passage
+        self.assertEqual(g.memo_misses, 7)
+        self.assertGreater(g.paths_skipped, 0)
+
+    def test_repeated_fingering(self):
+        g = player.Guitarist(self.song)
+        self.assertEqual(g.path[1:6], g.path[7:12])
+
+
 if __name__ == '__main__':
     all_open = [(0,0), (1,0), (2,0), (3,0), (4,0), (5,0)]
     open_c = [(0,0), (1,3), (2,2), (3,0), (4,1), (5,0)]
@@ -0,0 +1,161 @@
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import detect
+import music
+import player
+import service
+
+SONG = {'notes': ['E3', ['G3', 'B3'], 'A3', 'E4']}
+
+
+class TestService(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.service = service.Service(2, executor=ThreadPoolExecutor(2))
+        await self.service.start(0)
+        self.port = self.service.address[1]
+        self.reader, self.writer = await service.connect(self.port)
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        await self.service.close()
+
+    async def request(self, method, target, body=b''):
+        return await service.request(self.reader, self.writer,
+                                     method, target, body)
+
+    async def test_song(self):
+        status, body = await self.request('POST', '/song',
+                                          json.dumps(SONG).encode())
+        self.assertEqual(status, 200)
+        song = music.Song([music.Chord(n) if isinstance(n, list) else n
+                           for n in SONG['notes']])
+        self.assertEqual(body.decode(), str(player.Guitarist(song).arr))
+
+    async def test_values(self):
+        request = {'values': [[0, 4, 7], 2], 'durations': [0.5, 0.25]}
+        status, body = await self.request('POST', '/song',
+                                          json.dumps(request).encode())
+        self.assertEqual(status, 200)
+        song = music.Song.from_values([[0, 4, 7], 2], [0.5, 0.25])
+        self.assertEqual(body.decode(), str(player.Guitarist(song).arr))
+
+    async def test_image(self):
+        name = os.path.join('static', 'line.png')
+        with open(name, 'rb') as f:
+            status, body = await self.request('POST', '/image', f.read())
+        self.assertEqual(status, 200)
+        song = detect.StaffDetector(name).song()
+        self.assertEqual(body.decode(), str(player.Guitarist(song).arr))
+
+    async def test_errors(self):
+        self.assertEqual((await self.request('POST', '/song', b'{'))[0], 400)
+        self.assertEqual((await self.request('POST', '/image', b'x'))[0], 400)
+        middle = ['E3', 'A3', 'B3', 'E4'] * 2 + [['E3', 'G3']] + ['A3'] * 5
+        for notes in ([['E3', 'G3']], [['E3', 'G3'], 'A3', 'B3', 'E4'], middle):
+            unplayable = json.dumps({'notes': notes}).encode()
+            status, body = await self.request('POST', '/song', unplayable)
+            self.assertEqual(status, 400)
+            self.assertIn(b"Unplayable chords: ['E3', 'G3']", body)
+        self.assertEqual((await self.request('GET', '/song'))[0], 405)
+        self.assertEqual((await self.request('GET', '/nothing'))[0], 404)
+        # The connection is still usable after errors
+        status, body = await self.request('GET', '/metrics')
+        self.assertEqual(status, 200)
+        metrics = json.loads(body)
+        self.assertEqual(metrics['responses'],
+                         {'400': 5, '404': 1, '405': 1})
+
+    async def test_metrics_twice(self):
+        await self.request('POST', '/song', json.dumps(SONG).encode())
+        for responses in ({'200': 1}, {'200': 2}):
+            status, body = await self.request('GET', '/metrics')
+            self.assertEqual(status, 200)
+            metrics = json.loads(body)
+            self.assertEqual(metrics['responses'], responses)
+            # Only the transcription is timed, not the metrics themselves
+            self.assertEqual(len(self.service.metrics.latencies), 1)
+
+    async def test_too_large(self):
+        self.service.max_body = 10
+        reader, writer = await service.connect(self.port)
+        status, _ = await service.request(reader, writer, 'POST', '/song',
+                                          b'x' * 11)
+        writer.close()
+        self.assertEqual(status, 413)
+
+    async def test_bad_headers(self):
+        for head in (b'GET /metrics HTTP/1.1\r\n'
+                     + b'X-Padding: 1\r\n' * (service.MAX_HEADERS + 1),
+                     b'GET /metrics HTTP/1.1\r\nX-Long: '
+                     + b'x' * 2**17 + b'\r\n',
+                     b'GET /' + b'x' * 2**17 + b' HTTP/1.1\r\n'):
+            reader, writer = await service.connect(self.port)
+            writer.write(head + b'\r\n')
+            await writer.drain()
+            self.assertIn(b' 400 ', await reader.readline())
+            writer.close()
+
+    async def test_load(self):
+        report = await service.load_test('/song', json.dumps(SONG).encode(),
+                                         20, 2, self.port)
+        self.assertEqual(report['responses'], {'200': 20})
+        _, body = await self.request('GET', '/metrics')
+        metrics = json.loads(body)
+        self.assertEqual(metrics['responses'], {'200': 20})
+        self.assertLessEqual(metrics['latency']['p50'],
+                             metrics['latency']['p99'])
+
+
+class TestBackpressure(unittest.IsolatedAsyncioTestCase):
+    async def test_queue_full(self):
+        release = threading.Event()
+        routes = {'/wait': lambda data: str(release.wait(10))}
+        s = service.Service(1, queue=1, executor=ThreadPoolExecutor(1),
+                            routes=routes)
+        await s.start(0)
+        port = s.address[1]
+
+        async def send():
+            reader, writer = await service.connect(port)
+            try:
+                return await service.request(reader, writer, 'POST', '/wait')
+            finally:
+                writer.close()
+
+        # One request runs, one waits in the queue, and the last is refused
+        first = asyncio.create_task(send())
+        while not s.busy:
+            await asyncio.sleep(0.01)
+        second = asyncio.create_task(send())
+        while not s.jobs.qsize():
+            await asyncio.sleep(0.01)
+        self.assertEqual((await send())[0], 503)
+        release.set()
+        self.assertEqual(await first, (200, b'True'))
+        self.assertEqual(await second, (200, b'True'))
+        await s.close()
+
+    def test_unbounded_queue(self):
+        with self.assertRaises(ValueError):
+            service.Service(1, queue=0)
+
+    async def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'tab.sock')
+            s = service.Service(1, executor=ThreadPoolExecutor(1))
+            await s.start(path=path)
+            reader, writer = await service.connect(path=path)
+            status, _ = await service.request(reader, writer, 'POST', '/song',
+                                              json.dumps(SONG).encode())
+            writer.close()
+            await s.close()
+        self.assertEqual(status, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
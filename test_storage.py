@@ -0,0 +1,70 @@
+import unittest, os, tempfile
+import numpy as np
+import music, player, storage, tab
+
+
+class TestSongStorage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'song.bin')
+        self.song = music.Song(['E3', music.Chord(['C4', 'E4'], 1/8), 'G4'])
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        for mmap in (True, False):
+            with self.subTest(i=mmap):
+                storage.save_song(self.path, self.song)
+                song = storage.load_song(self.path, mmap)
+                self.assertEqual(song.notes, self.song.notes)
+                self.assertEqual(song.durations.tolist(), [1/4, 1/8, 1/4])
+                del song  # Release the file on Windows
+
+    def test_memory_mapped(self):
+        storage.save_song(self.path, self.song)
+        song = storage.load_song(self.path)
+        self.assertIsInstance(song.values.base, np.memmap)
+        self.assertFalse(song.values.flags.writeable)
+        self.assertEqual(song.transpose(2).values.tolist(), [-6, 2, 6, 9])
+
+    def test_empty_song(self):
+        storage.save_song(self.path, music.Song())
+        self.assertEqual(len(storage.load_song(self.path)), 0)
+
+    def test_wrong_kind(self):
+        storage.save_song(self.path, self.song)
+        with self.assertRaises(ValueError):
+            storage.load_arrangement(self.path)
+
+
+class TestArrangementStorage(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'arr.bin')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        song = music.Song(['E3', 'G3', music.Chord(['A3', 'E4'], 1/2), 'B3'])
+        arr = player.Guitarist(song).arr
+        storage.save_arrangement(self.path, arr)
+        self.assertEqual(storage.load_arrangement(self.path), arr)
+
+    def test_arrays(self):
+        arr = tab.Arrangement(notes=[(tab.Shape([None, 0, 0, 2, 3, 2]), 1/4)],
+                              width=16)
+        storage.save_arrangement(self.path, arr)
+        frets, durations, width = storage.load_arrangement_arrays(self.path)
+        self.assertEqual(frets.tolist(), [[-1, 0, 0, 2, 3, 2]])
+        self.assertEqual(durations.tolist(), [1/4])
+        self.assertEqual(width, 16)
+
+    def test_empty_arrangement(self):
+        storage.save_arrangement(self.path, tab.Arrangement())
+        self.assertEqual(storage.load_arrangement(self.path), tab.Arrangement())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import detect
+import player
+import watch
+
+PAGES = ('line', 'star')
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for name in PAGES:
+            shutil.copy(os.path.join('static', f'{name}.png'), self.folder)
+        self.age(*(f'{name}.png' for name in PAGES))
+        self.watcher = watch.Watcher(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def age(self, *filenames, seconds=10):
+        ''' Make files look as if they were last written seconds ago '''
+        past = time.time() - seconds
+        for filename in filenames:
+            os.utime(self.path(filename), (past, past))
+
+    def test_new_pages(self):
+        self.assertEqual(self.watcher.run_once(),
+                         {'transcribed': 2, 'unchanged': 0, 'failed': 0})
+        for name in PAGES:
+            song = detect.StaffDetector(self.path(f'{name}.png')).song()
+            with open(self.path(f'{name}.txt')) as f:
+                self.assertEqual(f.read(), str(player.Guitarist(song).arr))
+        # Nothing has changed since
+        self.assertEqual(self.watcher.scan(), [])
+
+    def test_changes(self):
+        self.watcher.run_once()
+        os.utime(self.path('line.png'))  # Touched, but too recently
+        self.assertEqual(self.watcher.scan(), [])
+        self.age('line.png', seconds=5)
+        self.assertEqual(self.watcher.run_once(),
+                         {'transcribed': 0, 'unchanged': 1, 'failed': 0})
+        shutil.copy(os.path.join('static', 'ignite.png'), self.path('line.png'))
+        self.age('line.png', seconds=4)
+        self.assertEqual(self.watcher.scan(), ['line.png'])
+        self.assertEqual(self.watcher.run_once()['transcribed'], 1)
+
+    def test_failures(self):
+        with open(self.path('torn.png'), 'wb') as f:
+            f.write(b'not an image')
+        self.age('torn.png')
+        with contextlib.redirect_stderr(io.StringIO()) as log:
+            self.assertEqual(self.watcher.run_once(),
+                             {'transcribed': 2, 'unchanged': 0, 'failed': 1})
+        self.assertIn('torn.png', log.getvalue())
+        self.assertIn('decode', self.watcher.fingerprints['torn.png']['error'])
+        # Failures are not retried until the file changes
+        self.assertEqual(self.watcher.scan(), [])
+
+    def test_unplayable(self):
+        # Some notes detected on this page can't be played on a guitar
+        shutil.copy(os.path.join('static', 'romance.png'), self.folder)
+        self.age('romance.png')
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(self.watcher.run_once()['failed'], 1)
+        self.assertIn('Unplayable chords',
+                      self.watcher.fingerprints['romance.png']['error'])
+        self.assertFalse(os.path.exists(self.path('romance.txt')))
+
+    def test_unexpected_errors(self):
+        def fail(path, low_memory=False):
+            raise IndexError('no staffs')
+
+        load_page = detect.load_page
+        detect.load_page = fail
+        try:
+            with contextlib.redirect_stderr(io.StringIO()):
+                counts = self.watcher.run_once()
+        finally:
+            detect.load_page = load_page
+        self.assertEqual(counts, {'transcribed': 0, 'unchanged': 0, 'failed': 2})
+        self.assertEqual(self.watcher.fingerprints['line.png']['error'],
+                         'IndexError: no staffs')
+
+    def test_restart(self):
+        self.watcher.run_once()
+        os.remove(self.path('star.png'))
+        self.watcher.scan()
+        restarted = watch.Watcher(self.folder)
+        self.assertEqual(list(restarted.fingerprints), ['line.png'])
+        with open(self.path(watch.FINGERPRINTS)) as f:
+            self.assertEqual(json.load(f), restarted.fingerprints)
+        self.assertEqual(restarted.scan(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
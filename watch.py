@@ -0,0 +1,202 @@
+'''
+This file concerns incremental transcription of a folder of scanned pages,
+as scanners add them, so that only new or changed pages are processed.
+
+Each page's tab is written beside it, as a .txt file of the same name. The
+size, modification time and content hash of every page processed are kept
+in FINGERPRINTS within the folder, so a restarted watcher resumes where it
+left off. Pages are only read when their size or modification time change,
+and only transcribed again when their content has changed too.
+
+The folder is checked every interval seconds, or, if inotify_simple is
+installed, as soon as files in it are written or moved into it.
+
+Usage:
+    python watch.py [folder] [interval]
+'''
+
+import hashlib
+import json
+import os
+import sys
+import time
+import detect, instrument
+from service import arrange
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+FINGERPRINTS = '.tab-fingerprints.json'
+EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class Watcher():
+    ''' Transcribes new or changed images in folder. Pages modified within
+    the last settle seconds are left for later, as they may still be being
+    written. cache is an optional DetectionCache, and ahead is the number
+    of pages a PageLoader decodes ahead of detection. '''
+    def __init__(self, folder, interval=2.0, settle=1.0, cache=None, ahead=2):
+        self.folder = folder
+        self.interval = interval
+        self.settle = settle
+        self.cache = cache
+        self.ahead = ahead
+        self.path = os.path.join(folder, FINGERPRINTS)
+        try:
+            with open(self.path) as f:
+                self.fingerprints = json.load(f)
+        except FileNotFoundError:
+            self.fingerprints = {}  # {filename: {size, mtime, hash, error}}
+
+    def __repr__(self):
+        return f"Watcher('{self.folder}')"
+
+    def scan(self):
+        ''' Return a sorted list of the filenames of new or changed images,
+        forgetting any which have been deleted '''
+        changed, present = [], set()
+        now = time.time()
+        for entry in os.scandir(self.folder):
+            if (not entry.is_file()
+                    or not entry.name.lower().endswith(EXTENSIONS)):
+                continue
+            present.add(entry.name)
+            stat = entry.stat()
+            if now - stat.st_mtime < self.settle:
+                continue
+            known = self.fingerprints.get(entry.name)
+            if (known is None or known['size'] != stat.st_size
+                    or known['mtime'] != stat.st_mtime_ns):
+                changed.append(entry.name)
+        deleted = set(self.fingerprints) - present
+        for name in deleted:
+            del self.fingerprints[name]
+        if deleted:
+            self._write()
+        return sorted(changed)
+
+    def process(self, names):
+        ''' Transcribe each of a list of image filenames whose content has
+        changed, recording their fingerprints as each one is done. Returns
+        a dict of the number of pages transcribed, unchanged and failed. '''
+        counts = {'transcribed': 0, 'unchanged': 0, 'failed': 0}
+        # Files changed after this are seen as changed again next time
+        stats = {}
+        for name in names:
+            try: stats[name] = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError: pass  # Deleted since scanning
+        names = list(stats)
+        paths = [os.path.join(self.folder, name) for name in names]
+        for name, (path, page) in zip(names, self._load(paths)):
+            stat = stats[name]
+            record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            if isinstance(page, Exception):
+                record['hash'] = None
+                record['error'] = self._failed(path, page)
+                counts['failed'] += 1
+                self._save(name, record)
+                continue
+            record['hash'] = fingerprint(page[0])
+            known = self.fingerprints.get(name)
+            if known is not None and known['hash'] == record['hash']:
+                # Touched, but not changed
+                record['error'] = known.get('error')
+                counts['unchanged'] += 1
+                self._save(name, record)
+                continue
+            try:
+                with instrument.timer('watch.transcribe'):
+                    detector = detect.StaffDetector(path, self.cache, page=page)
+                    tab = arrange(detector.song())
+                with open(os.path.splitext(path)[0] + '.txt', 'w') as f:
+                    f.write(tab)
+            except Exception as error:  # One bad page mustn't stop the rest
+                record['error'] = self._failed(path, error)
+                counts['failed'] += 1
+            else:
+                record['error'] = None
+                counts['transcribed'] += 1
+            self._save(name, record)
+        for kind, n in counts.items():
+            instrument.count(f'watch.{kind}', n)
+        return counts
+
+    def _load(self, paths):
+        ''' Yield (path, page) for each path, or (path, error) for those
+        which could not be read, with pages loaded by a PageLoader '''
+        while paths:
+            loader = iter(detect.PageLoader(paths, self.ahead))
+            try:
+                for path, page in loader:
+                    yield path, page
+                    paths = paths[1:]
+                return
+            except Exception as error:
+                # The loader stops at the first failure, so resume after it
+                yield paths[0], error
+                paths = paths[1:]
+
+    def _failed(self, path, error):
+        ''' Log a page which could not be transcribed, and return the error
+        message to record for it '''
+        message = f'{type(error).__name__}: {error}'
+        print(f'{path}: {message}', file=sys.stderr, flush=True)
+        return message
+
+    def _save(self, name, record):
+        ''' Record the fingerprint of a page, and write them all to disk '''
+        self.fingerprints[name] = record
+        self._write()
+
+    def _write(self):
+        ''' Write fingerprints atomically, so they are never incomplete '''
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.fingerprints, f, indent=1, sort_keys=True)
+        os.replace(temp, self.path)
+
+    def run_once(self):
+        ''' Process every new or changed image, returning counts as from
+        process() '''
+        return self.process(self.scan())
+
+    def run(self, rounds=None):
+        ''' Process images as they arrive, printing a summary of each round
+        which finds any, forever or for a number of rounds '''
+        notify = None
+        if inotify_simple is not None:
+            flags = inotify_simple.flags
+            notify = inotify_simple.INotify()
+            notify.add_watch(self.folder, flags.CLOSE_WRITE | flags.MOVED_TO
+                             | flags.DELETE | flags.MOVED_FROM)
+        try:
+            done = 0
+            while rounds is None or done < rounds:
+                start = time.perf_counter()
+                counts = self.run_once()
+                if any(counts.values()):
+                    print(f'{self.folder}: {counts} in '
+                          f'{time.perf_counter() - start:.2f}s', flush=True)
+                done += 1
+                if notify is not None:
+                    # Also wake up for pages left to settle
+                    notify.read(timeout=int(1000 * self.interval))
+                else:
+                    time.sleep(self.interval)
+        finally:
+            if notify is not None:
+                notify.close()
+
+
+if __name__ == '__main__':
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    try:
+        Watcher(folder, interval, cache=detect.DetectionCache()).run()
+    except KeyboardInterrupt:
+        pass